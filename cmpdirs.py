@@ -11,26 +11,294 @@
 import sys
 import os
 import os.path
+import time
+from collections import namedtuple
 
-def walk_tree(rootdir, visitdir=None, onfile=None):
-    from os import walk
-    from os.path import join
+def read_directory(dirpath, accept=None):
+    """
+    Returns pair (list of (name, kind, stat), list of subdirectories)
+    for directory; directories come first, then files, each in order
+    of os.scandir.
+
+    Stat is taken from os.scandir entry (symbolic links are followed,
+    as os.stat does).  Entries rejected by accept(dirpath, name, isdir)
+    are skipped before they are stat'ed; links to directories are listed,
+    but not returned as subdirectories.
+    """
+    dirs  = []
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    isdir = entry.is_dir()
+                    if accept and not accept(dirpath, entry.name, isdir):
+                        continue
+
+                    if isdir:
+                        dirs.append((entry.name, 'd', entry.stat()))
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    else:
+                        files.append((entry.name, 'f', entry.stat()))
+                except OSError as e:
+                    sys.stderr.write("%s\n" % e)
+    except OSError as e:
+        sys.stderr.write("%s\n" % e)
+
+    return (dirs + files, subdirs)
+
+
+def scan_tree(rootdir, accept=None, jobs=1, window=None):
+    """
+    Yields pairs (dirpath, list of (name, kind, stat)) for rootdir and
+    all its subdirectories, in pre-order: a directory comes before its
+    subdirectories, which come in order returned by read_directory.
+
+    With jobs > 1 directories are read ahead by a pool of threads, at most
+    window directories (default 4 * jobs) at once; results are still
+    yielded in order.
+    """
+    if jobs == 1:
+        stack = [rootdir]
+        while stack:
+            dirpath = stack.pop()
+            entries, subdirs = read_directory(dirpath, accept)
+
+            yield (dirpath, entries)
+
+            stack.extend(reversed(subdirs))
+
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    if window is None:
+        window = 4 * jobs
+
+    executor = ThreadPoolExecutor(jobs)
+
+    # stack of [dirpath, future]; future is None until the read is submitted
+    stack   = [[rootdir, None]]
+    pending = 0
+
+    def submit():
+        # reads are submitted in the order of stack from the top; at most
+        # window entries are submitted, so at most 2 * window are looked at
+        nonlocal pending
+        i = len(stack)
+        while pending < window and i > 0:
+            i -= 1
+            if stack[i][1] is None:
+                stack[i][1] = executor.submit(read_directory, stack[i][0], accept)
+                pending += 1
+
+    try:
+        while stack:
+            submit()
+            dirpath, future = stack.pop()
+            entries, subdirs = future.result()
+            pending -= 1
+
+            yield (dirpath, entries)
+
+            stack.extend([subdir, None] for subdir in reversed(subdirs))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def translate_pattern(pattern):
+    """
+    Translate gitignore-like pattern to pair (regular expression matching
+    relative path, True if pattern matches only directories).
+
+    Pattern with a slash (except the trailing one) is anchored to the
+    base directory, otherwise it matches name at any level; trailing
+    slash matches only directories; '*' and '?' don't match '/', '**'
+    matches any number of directories.
+    """
+    import re
+
+    dir_only = pattern.endswith('/')
+    pattern  = pattern.rstrip('/')
+    anchored = '/' in pattern
+    if pattern.startswith('/'):
+        pattern = pattern[1:]
+
+    regex = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            # trailing '/**' matches contents, but not directory itself
+            regex.append('.+' if i + 2 == n and pattern[i - 1:i] == '/' else '.*')
+            i += 2
+        elif c == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif c == '?':
+            regex.append('[^/]')
+            i += 1
+        elif c == '[' and pattern.find(']', i + 2) > 0:
+            j = pattern.find(']', i + 2)
+            chars = pattern[i + 1:j].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex.append('[%s]' % chars)
+            i = j + 1
+        elif c == '\\' and i + 1 < n:
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(c))
+            i += 1
+
+    if not anchored:
+        regex.insert(0, '(?:.*/)?')
+
+    return (''.join(regex), dir_only)
+
+
+class Rules(object):
+    """
+    gitignore-like rules compiled into regular expressions, one for
+    directories and one for files (without directory-only rules); rules
+    are alternatives in reversed order, so the last matching rule wins.
+
+    Invalid pattern raises ValueError, or is skipped after calling
+    onerror(line, message) if onerror is given.
+    """
+
+    def __init__(self, lines, onerror=None):
+        import re
+
+        self.negated = []
+        dirs  = []
+        files = []
+        for line in lines:
+            line = line.rstrip('\n').rstrip()
+            if not line or line.startswith('#'):
+                continue
+
+            negated = line.startswith('!')
+            pattern = line[1:] if negated else line
+
+            regex, dir_only = translate_pattern(pattern)
+            try:
+                re.compile(regex)
+            except re.error as e:
+                if onerror is None:
+                    raise ValueError("invalid pattern '%s': %s" % (line, e.msg))
+                onerror(line, e.msg)
+                continue
+
+            alternative = '(?P<r%d>%s)' % (len(self.negated), regex)
+            dirs.append(alternative)
+            if not dir_only:
+                files.append(alternative)
+            self.negated.append(negated)
+
+        def combine(alternatives):
+            if alternatives:
+                return re.compile('|'.join(reversed(alternatives)), re.DOTALL)
+
+        self.dirs_regex  = combine(dirs)
+        self.files_regex = combine(files)
+
+    def __bool__(self):
+        return self.dirs_regex is not None
+
+    def match(self, path, isdir):
+        "True if path is excluded, False if included, None if no rule matches"
+        regex = self.dirs_regex if isdir else self.files_regex
+        if regex is None:
+            return None
+
+        m = regex.fullmatch(path)
+        if m is None:
+            return None
+
+        return not self.negated[int(m.lastgroup[1:])]
 
-    for dirpath, dirnames, filenames in walk(rootdir):
-        if visitdir:
-            i = 0
-            while i < len(dirnames):
-                if not visitdir(dirpath, dirnames[i]):
-                    del dirnames[i]
-                else:
-                    i += 1
-        if onfile:
-            for dirname in dirnames:
-                onfile(join(dirpath, dirname), 'd')
 
-            for filename in filenames:
-                onfile(join(dirpath, filename), 'f')
-    #
+class Filter(object):
+    """
+    Decides which entries of tree are skipped.  Rules given at command
+    line are relative to the root, rules read from ignore files in
+    directories (like .gitignore) are relative to their directories.
+    Command line rules go first, then ignore files from the nearest one.
+    """
+
+    def __init__(self, rootdir, rules=(), ignore_file=None):
+        self.root  = rootdir.rstrip(os.sep) or os.sep
+        self.base  = os.path.join(self.root, '')
+        self.rules = Rules(rules)
+        self.ignore_file = ignore_file
+        self.signature   = (tuple(rules), ignore_file)
+
+        # directory => tuple of (base, Rules) of ignore files, nearest first
+        self.chains = {}
+
+    def chain(self, dirpath):
+        key = dirpath.rstrip(os.sep) or os.sep
+        chain = self.chains.get(key)
+        if chain is None:
+            if len(key) > len(self.root):
+                chain = self.chain(os.path.dirname(key))
+            else:
+                chain = ()
+
+            rules = self.read_rules(key)
+            if rules:
+                chain = ((os.path.join(key, ''), rules),) + chain
+
+            self.chains[key] = chain
+
+        return chain
+
+    def read_rules(self, dirpath):
+        if self.ignore_file is None:
+            return None
+
+        path = os.path.join(dirpath, self.ignore_file)
+
+        def onerror(line, message):
+            # like git, an invalid pattern is skipped
+            sys.stderr.write("%s: invalid pattern '%s' skipped: %s\n" % (path, line, message))
+
+        try:
+            with open(path, errors='surrogateescape') as f:
+                return Rules(f, onerror)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            sys.stderr.write("%s\n" % e)
+            return None
+
+    def accept(self, dirpath, name, isdir):
+        path = os.path.join(dirpath, name)
+        excluded = self.rules.match(path[len(self.base):], isdir)
+        if excluded is None:
+            for base, rules in self.chain(dirpath):
+                excluded = rules.match(path[len(base):], isdir)
+                if excluded is not None:
+                    break
+
+        return not excluded
+
+
+# kind is 'd' or 'f'; dev, ino, mtime_ns and ctime_ns are needed by
+# checksum cache: ctime changes on any write and can't be set back,
+# a file rewritten in place with mtime restored gets a new ctime
+Entry = namedtuple('Entry', 'id mtime size kind dev ino mtime_ns ctime_ns')
+
+def make_entry(id, kind, s):
+    return Entry(id, s.st_mtime, s.st_size, kind, s.st_dev, s.st_ino, s.st_mtime_ns, s.st_ctime_ns)
 
 
 class DirectoryList(object):
@@ -42,23 +310,256 @@ class DirectoryList(object):
 
         self.pathlen = len(self.rootdir)
         self.files   = {}
+        self.root_mtime_ns = None
+        self.filter  = None
 
 
-    def __visitdir(self, dirpath, dirname):
-        return True
+    def __accept(self, dirpath, name, isdir):
+        if self.filter is None:
+            return True
 
+        return self.filter.accept(dirpath, name, isdir)
 
-    def __onfile(self, path, kind):
-        from os import stat
-        s = os.stat(path)
+
+    def __onfile(self, path, kind, s):
         p = path[self.pathlen:]
 
-        # path => (id, mtime, size, kind)
-        self.files[p] = (len(self.files), s.st_mtime, s.st_size, kind)
+        # path => Entry
+        self.files[p] = make_entry(len(self.files), kind, s)
+
+    def scan(self, jobs=1):
+        from os.path import join
 
-    def scan(self):
         self.files = {}
-        walk_tree(self.rootdir, self.__visitdir, self.__onfile)
+        self.root_mtime_ns = os.stat(self.rootdir).st_mtime_ns
+        for dirpath, entries in scan_tree(self.rootdir, self.__accept, jobs):
+            for name, kind, s in entries:
+                self.__onfile(join(dirpath, name), kind, s)
+
+    SNAPSHOT_VERSION = 2
+
+    def save(self, filename):
+        "save listing to gzipped pickle file"
+        import gzip, pickle
+
+        # plain tuples, so that a snapshot doesn't depend on module name
+        state = {
+            'version':       self.SNAPSHOT_VERSION,
+            'rootdir':       self.rootdir,
+            'root_mtime_ns': self.root_mtime_ns,
+            'filter':        self.filter.signature if self.filter else None,
+            'files':         [(path,) + tuple(entry[1:]) for path, entry in self.files.items()],
+        }
+
+        tmp = filename + ".tmp"
+        with gzip.open(tmp, 'wb', compresslevel=3) as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+
+    def load(self, filename):
+        "load listing saved by save, raises ValueError if it's not of this directory"
+        import gzip, pickle
+
+        with gzip.open(filename, 'rb') as f:
+            state = pickle.load(f)
+
+        if state.get('version') != self.SNAPSHOT_VERSION:
+            raise ValueError("'%s' has unsupported format" % filename)
+        if state['rootdir'] != self.rootdir:
+            raise ValueError("'%s' is a snapshot of '%s'" % (filename, state['rootdir']))
+        if state.get('filter') != (self.filter.signature if self.filter else None):
+            raise ValueError("'%s' was made with other filter rules" % filename)
+
+        self.root_mtime_ns = state['root_mtime_ns']
+        self.files = {}
+        for item in state['files']:
+            self.files[item[0]] = Entry(len(self.files), *item[1:])
+
+    def rescan(self, trust_mtime=False):
+        """
+        Update loaded listing: only directories whose mtime has changed
+        are read again, entries of other directories are stat'ed again.
+        With trust_mtime files of unchanged directories are assumed to be
+        unchanged too, then just directories are stat'ed.
+        """
+        import stat
+        from os.path import join, split
+
+        # relative path of directory => [(name, Entry)] in order of listing
+        children = {}
+        for path, entry in self.files.items():
+            dirname, name = split(path)
+            children.setdefault(dirname, []).append((name, entry))
+
+        old = self.files
+        self.files = {}
+
+        def add(path, kind, s):
+            self.__onfile(join(self.rootdir, path), kind, s)
+
+        s = os.stat(self.rootdir)
+        stack = [('', s.st_mtime_ns != self.root_mtime_ns)]
+        self.root_mtime_ns = s.st_mtime_ns
+        while stack:
+            path, changed = stack.pop()
+            dirpath = join(self.rootdir, path)
+            subdirs = []
+            if changed:
+                entries, descend = read_directory(dirpath, self.__accept)
+                descend = set(descend)
+                for name, kind, s in entries:
+                    add(join(path, name), kind, s)
+                    if kind == 'd' and join(dirpath, name) in descend:
+                        old_entry = old.get(join(path, name))
+                        if old_entry is not None and old_entry.kind == 'd':
+                            subdirs.append((join(path, name), s.st_mtime_ns != old_entry.mtime_ns))
+                        else:
+                            subdirs.append((join(path, name), True))
+            else:
+                for name, entry in children.get(path, []):
+                    if not self.__accept(dirpath, name, entry.kind == 'd'):
+                        continue
+
+                    if entry.kind == 'f' and trust_mtime:
+                        self.files[join(path, name)] = entry._replace(id=len(self.files))
+                        continue
+
+                    try:
+                        ls = os.lstat(join(dirpath, name))
+                        s  = os.stat(join(dirpath, name)) if stat.S_ISLNK(ls.st_mode) else ls
+                    except OSError as e:
+                        sys.stderr.write("%s\n" % e)
+                        continue
+
+                    add(join(path, name), entry.kind, s)
+                    if entry.kind == 'd' and not stat.S_ISLNK(ls.st_mode):
+                        subdirs.append((join(path, name), s.st_mtime_ns != entry.mtime_ns))
+
+            stack.extend(reversed(subdirs))
+
+    def invalidate(self, path):
+        """
+        Mark directory of path as changed, so that the next rescan reads it
+        and stats its entries again: a file rewritten in place (e.g. by the
+        mirror) doesn't change mtime of its directory.
+        """
+        parent = os.path.dirname(path)
+        if not parent:
+            self.root_mtime_ns = None
+        else:
+            entry = self.files.get(parent)
+            if entry is not None:
+                self.files[parent] = entry._replace(mtime_ns=None)
+
+    def listdir(self, path):
+        """
+        Returns list of (name, Entry, descend) for directory given by
+        relative path, sorted by name; descend is False for links to
+        directories.  Used by streaming compare, files are not kept.
+        """
+        from os.path import join
+
+        dirpath = join(self.rootdir, path)
+        entries, subdirs = read_directory(dirpath, self.__accept)
+        subdirs = set(subdirs)
+
+        result = [(name, make_entry(None, kind, s), join(dirpath, name) in subdirs)
+                  for name, kind, s in entries]
+        result.sort(key=lambda item: item[0])
+        return result
+
+
+def run_at_once(functions):
+    "call all functions (e.g. scans of trees) at once, each one in its own thread"
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(len(functions)) as executor:
+        futures = [executor.submit(function) for function in functions]
+        for future in futures:
+            future.result()
+
+
+def scan_with_snapshot(listing, filename, jobs=1, trust_mtime=False):
+    "rescan listing loaded from snapshot file (or scan it); it's saved after compare"
+    try:
+        listing.load(filename)
+    except FileNotFoundError:
+        listing.scan(jobs)
+    except (ValueError, OSError, EOFError) as e:
+        sys.stderr.write("Can't use snapshot: %s\n" % e)
+        listing.scan(jobs)
+    else:
+        listing.rescan(trust_mtime)
+
+
+def calc_md5(path, bufsize=1024*1024):
+    "md5 sum of file, read in chunks"
+    from hashlib import md5
+
+    sum = md5()
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            sum.update(view[:n])
+
+    return sum.digest()
+
+
+class ChecksumCache(object):
+    "md5 sums of files kept in SQLite database, valid while size, mtime and ctime don't change"
+
+    def __init__(self, filename, batch=1000, interval=30.0):
+        import sqlite3
+
+        self.batch    = batch       # number of new sums written in one transaction
+        self.interval = interval    # max time (in seconds) between transactions
+        self.pending  = 0
+        self.last_flush = time.monotonic()
+
+        self.db = sqlite3.connect(str(filename))
+        self.db.execute("PRAGMA journal_mode=WAL")
+
+        # table of older version, without ctime, can't be trusted
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(md5)")]
+        if columns and 'ctime_ns' not in columns:
+            self.db.execute("DROP TABLE md5")
+
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS md5 ("
+            " dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, ctime_ns INTEGER, sum BLOB,"
+            " PRIMARY KEY (dev, ino))"
+        )
+
+    def get(self, entry):
+        row = self.db.execute(
+            "SELECT sum FROM md5 WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND ctime_ns=?",
+            (entry.dev, entry.ino, entry.size, entry.mtime_ns, entry.ctime_ns)
+        ).fetchone()
+        if row is not None:
+            return bytes(row[0])
+
+    def set(self, entry, sum):
+        self.db.execute(
+            "INSERT OR REPLACE INTO md5 VALUES (?, ?, ?, ?, ?, ?)",
+            (entry.dev, entry.ino, entry.size, entry.mtime_ns, entry.ctime_ns, sum)
+        )
+        self.pending += 1
+        if self.pending >= self.batch or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        "commit sums calculated so far, they survive an interrupted run"
+        self.db.commit()
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.db.close()
 
 
 class CompareBase(object):
@@ -70,6 +571,19 @@ class CompareBase(object):
     OLDER       = 3
     MISSING1    = 4
     MISSING2    = 5
+    CONTENTDIFF = 6
+
+    # set checksum to a ChecksumCache to compare contents of files
+    # having the same size; sums are calculated by jobs threads
+    checksum    = None
+    jobs        = 1
+
+    # set by compare_stream
+    stream      = False
+
+    # with detect_moves files missing in second dir that match files
+    # missing in first one are reported by on_move (not in compare_stream)
+    detect_moves = False
 
     def __init__(self, dir1, dir2):
         self.dir1 = dir1
@@ -79,33 +593,187 @@ class CompareBase(object):
         "relative path and compare result (one of constants)"
         pass
 
+    def on_move(self, path1, path2, kind):
+        """
+        file path2 of second dir is the same as path1 of first dir;
+        by default it's reported as missing in both dirs
+        """
+        self.on_compare(path1, kind, CompareBase.MISSING2)
+        self.on_compare(path2, kind, CompareBase.MISSING1)
+
     def on_compare_start(self):
         pass
 
     def on_compare_end(self):
         pass
 
+    def find_content_diff(self, pairs=None, executor=None):
+        """
+        Paths of files having the same size in both dirs, but different
+        contents.  Pairs is a list of (path, entry1, entry2), by default
+        all files present in both listings.
+        """
+        from os.path import join
+
+        if pairs is None:
+            pairs = []
+            for path, entry1 in self.dir1.files.items():
+                entry2 = self.dir2.files.get(path)
+                if entry1.kind == 'f' and entry2 is not None and entry2.kind == 'f' \
+                   and entry1.size == entry2.size:
+                    pairs.append((path, entry1, entry2))
+
+        entries = []
+        for path, entry1, entry2 in pairs:
+            entries.append((join(self.dir1.rootdir, path), entry1))
+            entries.append((join(self.dir2.rootdir, path), entry2))
+
+        sums = self.get_sums(entries, executor)
+
+        # files that couldn't be read are not reported
+        different = set()
+        for k, (path, _, _) in enumerate(pairs):
+            sum1, sum2 = sums[2*k], sums[2*k + 1]
+            if sum1 is not None and sum2 is not None and sum1 != sum2:
+                different.add(path)
+
+        return different
+
+    def get_sums(self, entries, executor=None):
+        """
+        Checksums of files given as list of (full path, Entry), None for
+        files that couldn't be read; sums missing in cache are calculated
+        in threads, at most 4 * jobs files at once.  Each sum is stored in
+        cache as soon as it's known, so an interrupted run keeps them.
+        """
+        from collections import deque
+
+        def calc(path):
+            try:
+                return calc_md5(path)
+            except OSError as e:
+                sys.stderr.write("%s\n" % e)
+
+        sums    = [self.checksum.get(entry) for _, entry in entries]
+        missing = [i for i, sum in enumerate(sums) if sum is None]
+
+        def store(i, sum):
+            if sum is not None:
+                sums[i] = sum
+                self.checksum.set(entries[i][1], sum)
+
+        if executor is None and self.jobs == 1:
+            for i in missing:
+                store(i, calc(entries[i][0]))
+
+            return sums
+
+        own_executor = executor is None
+        if own_executor:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(self.jobs)
+
+        window  = 4 * self.jobs
+        pending = deque()
+        try:
+            for i in missing:
+                pending.append((i, executor.submit(calc, entries[i][0])))
+                while len(pending) > window:
+                    i, future = pending.popleft()
+                    store(i, future.result())
+
+            while pending:
+                i, future = pending.popleft()
+                store(i, future.result())
+        finally:
+            if own_executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        return sums
+
+    def find_moves(self):
+        """
+        Pairs files missing in second dir with files missing in first one,
+        having the same size and mtime (and contents, if checksum is set).
+        Returns dict: path in first dir => path in second dir.
+        """
+        from os.path import join, basename
+
+        candidates = {}
+        for path, entry in self.dir2.files.items():
+            if entry.kind == 'f' and path not in self.dir1.files:
+                candidates.setdefault((entry.size, entry.mtime_ns), []).append(path)
+
+        missing = [(path, entry) for path, entry in self.dir1.files.items()
+                   if entry.kind == 'f' and path not in self.dir2.files]
+
+        # files of the same name are paired first, then the rest
+        moves = {}
+        for same_name in (True, False):
+            for path, entry in missing:
+                if path in moves:
+                    continue
+
+                paths = candidates.get((entry.size, entry.mtime_ns))
+                if not paths:
+                    continue
+
+                for i, old in enumerate(paths):
+                    if not same_name or basename(old) == basename(path):
+                        moves[path] = paths.pop(i)
+                        break
+
+        if self.checksum is not None:
+            entries = []
+            for path, old in moves.items():
+                entries.append((join(self.dir1.rootdir, path), self.dir1.files[path]))
+                entries.append((join(self.dir2.rootdir, old), self.dir2.files[old]))
+
+            sums = self.get_sums(entries)
+            for k, path in enumerate(list(moves)):
+                if sums[2*k] is None or sums[2*k] != sums[2*k + 1]:
+                    del moves[path]
+
+        return moves
+
     def compare(self):
         on_compare = self.on_compare
 
+        if self.checksum is not None:
+            different = self.find_content_diff()
+        else:
+            different = set()
+
+        if self.detect_moves:
+            moves = self.find_moves()
+        else:
+            moves = {}
+
+        moved = set(moves.values())
+
         self.on_compare_start()
 
-        for path, (id, mtime, size, kind) in self.dir1.files.items():
+        for path, entry in self.dir1.files.items():
+            kind = entry.kind
             if kind == 'd': # directory
                 if path not in self.dir2.files:
                     on_compare(path, kind, CompareBase.MISSING2)
                 else:
                     on_compare(path, kind, CompareBase.SAME)
             elif kind == 'f':
-                if path not in self.dir2.files:
+                if path in moves:
+                    self.on_move(path, moves[path], kind)
+                elif path not in self.dir2.files:
                     on_compare(path, kind, CompareBase.MISSING2)
                 else:
-                    (_, mtime2, size2, _) = self.dir2.files[path]
-                    if size != size2:
+                    entry2 = self.dir2.files[path]
+                    if entry.size != entry2.size:
                         on_compare(path, kind, CompareBase.SIZEDIFF)
-                    elif mtime < mtime2:
+                    elif path in different:
+                        on_compare(path, kind, CompareBase.CONTENTDIFF)
+                    elif entry.mtime < entry2.mtime:
                         on_compare(path, kind, CompareBase.OLDER)
-                    elif mtime > mtime2:
+                    elif entry.mtime > entry2.mtime:
                         on_compare(path, kind, CompareBase.YOUNGER)
                     else:
                         on_compare(path, kind, CompareBase.SAME)
@@ -113,13 +781,134 @@ class CompareBase(object):
                 raise AssertionError("Unknown kind of path ('%s')" % kind)
         #
         
-        for path, (_, _, _, kind) in self.dir2.files.items():
-            if path not in self.dir1.files:
-                on_compare(path, kind, CompareBase.MISSING1)
+        for path, entry in self.dir2.files.items():
+            if path not in self.dir1.files and path not in moved:
+                on_compare(path, entry.kind, CompareBase.MISSING1)
         #
 
         self.on_compare_end()
 
+    def compare_stream(self):
+        """
+        Compare walking both trees at once, directory by directory: sorted
+        listings of a directory are merge-joined and results are reported
+        immediately, so memory depends on depth and width of trees, not
+        on number of files.  Listings of DirectoryLists are not used.
+
+        Results come in other order than from compare: contents of a
+        directory missing in first dir are reported before the directory.
+        """
+        self.stream = True
+        self.on_compare_start()
+
+        if self.checksum is not None and self.jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(self.jobs)
+        else:
+            executor = None
+
+        try:
+            # stack of pending actions: (path, None, read1, read2) is
+            # a directory to compare, (path, kind, result) a result to report;
+            # an explicit stack, so that depth of trees is not limited
+            stack = [('', None, True, True)]
+            while stack:
+                action = stack.pop()
+                if action[1] is None:
+                    path, _, read1, read2 = action
+                    stack.extend(reversed(self.__compare_dir(path, read1, read2, executor)))
+                else:
+                    self.on_compare(*action)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        self.on_compare_end()
+
+    def __compare_dir(self, path, read1, read2, executor):
+        "returns list of actions (see compare_stream) for directory, in order"
+        from os.path import join
+
+        list1 = self.dir1.listdir(path) if read1 else []
+        list2 = self.dir2.listdir(path) if read2 else []
+
+        # merge-join of sorted listings
+        merged = []
+        i = j = 0
+        while i < len(list1) or j < len(list2):
+            if j == len(list2) or (i < len(list1) and list1[i][0] < list2[j][0]):
+                merged.append((list1[i], None))
+                i += 1
+            elif i == len(list1) or list2[j][0] < list1[i][0]:
+                merged.append((None, list2[j]))
+                j += 1
+            else:
+                merged.append((list1[i], list2[j]))
+                i += 1
+                j += 1
+
+        if self.checksum is not None:
+            pairs = [(join(path, item1[0]), item1[1], item2[1])
+                     for item1, item2 in merged
+                     if item1 is not None and item2 is not None
+                        and item1[1].kind == item2[1].kind == 'f'
+                        and item1[1].size == item2[1].size]
+            different = self.find_content_diff(pairs, executor)
+        else:
+            different = set()
+
+        actions = []
+        for item1, item2 in merged:
+            if item1 is not None and item2 is not None and item1[1].kind != item2[1].kind:
+                # file replaced by directory or vice versa: remove, then create
+                self.__missing1(actions, join(path, item2[0]), item2)
+                self.__missing2(actions, join(path, item1[0]), item1)
+            elif item2 is None:
+                self.__missing2(actions, join(path, item1[0]), item1)
+            elif item1 is None:
+                self.__missing1(actions, join(path, item2[0]), item2)
+            else:
+                name, entry, descend1 = item1
+                _, entry2, descend2 = item2
+                subpath = join(path, name)
+                if entry.kind == 'd':
+                    actions.append((subpath, 'd', CompareBase.SAME))
+                    actions.append((subpath, None, descend1, descend2))
+                elif entry.size != entry2.size:
+                    actions.append((subpath, 'f', CompareBase.SIZEDIFF))
+                elif subpath in different:
+                    actions.append((subpath, 'f', CompareBase.CONTENTDIFF))
+                elif entry.mtime < entry2.mtime:
+                    actions.append((subpath, 'f', CompareBase.OLDER))
+                elif entry.mtime > entry2.mtime:
+                    actions.append((subpath, 'f', CompareBase.YOUNGER))
+                else:
+                    actions.append((subpath, 'f', CompareBase.SAME))
+
+        return actions
+
+    def __missing2(self, actions, path, item):
+        # directory is reported before its contents
+        name, entry, descend = item
+        actions.append((path, entry.kind, CompareBase.MISSING2))
+        if entry.kind == 'd' and descend:
+            actions.append((path, None, True, False))
+
+    def __missing1(self, actions, path, item):
+        # directory is reported after its contents
+        name, entry, descend = item
+        if entry.kind == 'd' and descend:
+            actions.append((path, None, False, True))
+        actions.append((path, entry.kind, CompareBase.MISSING1))
+
+
+class PrintList(object):
+    "used instead of list in streaming mode: lines are printed at once"
+
+    def append(self, line):
+        print(line)
+
+
 class CompareDescription(CompareBase):
     "print simple description of changes"
     def __init__(self, listing1, listing2):
@@ -145,6 +934,8 @@ class CompareDescription(CompareBase):
             L.append("is older")
         elif result == CompareBase.SIZEDIFF:
             L.append("has different size")
+        elif result == CompareBase.CONTENTDIFF:
+            L.append("has different contents")
         elif result == CompareBase.MISSING2:
             L.append("not exists in second dir")
         elif result == CompareBase.MISSING1:
@@ -152,23 +943,82 @@ class CompareDescription(CompareBase):
 
         print(" ".join(L))
 
+    def on_move(self, path1, path2, kind):
+        print("file %s exists as %s in second dir" % (path1, path2))
+
 
 class CompareShell(CompareBase):
     "print shell script that makes perfect copy of first directory"
+
+    # files of at least delta_size bytes are updated by rsync, which
+    # sends only changed blocks
+    delta_size = None
+
     def __init__(self, listing1, listing2):
         CompareBase.__init__(self, listing1, listing2)
 
+    def on_move(self, path1, path2, kind):
+        from os.path import join
+
+        self.mvfiles.append(
+            'echo move "%s" "%s"' % (path2, path1)
+        )
+        self.mvfiles.append(
+            'mv -f "%s" "%s"' % (join(self.dir2.rootdir, path2), join(self.dir2.rootdir, path1))
+        )
+
+    def __copy_changed(self, path):
+        from os.path import join, getsize
+
+        src = join(self.dir1.rootdir, path)
+        dst = join(self.dir2.rootdir, path)
+
+        size = None
+        if self.delta_size is not None:
+            try:
+                size = getsize(src)
+            except OSError as e:
+                # file has gone since scan: cp in the script reports it
+                sys.stderr.write("%s\n" % e)
+
+        if size is not None and size >= self.delta_size:
+            self.cpfiles.append(
+                'echo update "%s"' % path
+            )
+            self.cpfiles.append(
+                'rsync -a -X --inplace --no-whole-file "%s" "%s"' % (src, dst)
+            )
+        else:
+            self.cpfiles.append(
+                'echo copy "%s"' % path
+            )
+            self.cpfiles.append(
+                'cp -f --preserve=all "%s" "%s"' % (src, dst)
+            )
+
     def on_compare_start(self):
+        if self.stream:
+            # commands come in a safe order, there is no need to buffer them
+            self.mkdirs = self.rmdirs = self.cpfiles = self.rmfiles = PrintList()
+            return
+
         self.mkdirs = []
         self.rmdirs = []
+        self.mvfiles = []
         self.cpfiles = []
         self.rmfiles = []
 
 
     def on_compare_end(self):
+        if self.stream:
+            return
+
         if self.mkdirs:
             print("\n".join(self.mkdirs))
 
+        if self.mvfiles:
+            print("\n".join(self.mvfiles))
+
         if self.cpfiles:
             print("\n".join(self.cpfiles))
 
@@ -176,7 +1026,8 @@ class CompareShell(CompareBase):
             print("\n".join(self.rmfiles))
 
         if self.rmdirs:
-            print("\n".join(self.rmdirs))
+            # subdirectories must be removed first
+            print("\n".join(sorted(self.rmdirs, reverse=True)))
 
 
     def on_compare(self, path, kind, result):
@@ -188,22 +1039,12 @@ class CompareShell(CompareBase):
         if kind not in ['d', 'f']:
             raise AssertionError("Unknown kind of path ('%s')" % kind)
 
-        if result == CompareBase.SIZEDIFF:
+        if result in [CompareBase.SIZEDIFF, CompareBase.CONTENTDIFF]:
             if kind == 'f':
-                self.cpfiles.append(
-                    'echo copy "%s"' % path
-                )
-                self.cpfiles.append(
-                    'cp -f --preserve=all "%s" "%s"' % (join(self.dir1.rootdir, path), join(self.dir2.rootdir, path))
-                )
+                self.__copy_changed(path)
         elif result in [CompareBase.YOUNGER, CompareBase.OLDER]:
             if kind == 'f':
-                self.cpfiles.append(
-                    'echo copy "%s"' % path
-                )
-                self.cpfiles.append(
-                    'cp -f --preserve=all "%s" "%s"' % (join(self.dir1.rootdir, path), join(self.dir2.rootdir, path))
-                )
+                self.__copy_changed(path)
         elif result == CompareBase.MISSING2:
             if kind == 'f':
                 self.cpfiles.append(
@@ -230,32 +1071,406 @@ class CompareShell(CompareBase):
                 )
         #
     
-def help(ret=0):
-    print(
-        """
-        usage: program M directory1 directory2
+def copy_file(src, dst):
+    """
+    Copy file with its metadata, like cp --preserve=all; data is written
+    to a temporary file, which then replaces dst.  Data is copied by the
+    kernel (copy_file_range or sendfile) where possible.  Returns number
+    of bytes copied.
+    """
+    import shutil
+    from os.path import dirname, basename, join
 
-         M is method of compare result presentation:
-         d - print simple description
-         s - print shell script that makes mirr of of dir1 in dir2
-        """
-    )
-    sys.exit(ret)
+    tmp = join(dirname(dst), ".%s.%d.cmpdirs-tmp" % (basename(dst), os.getpid()))
+    with open(src, 'rb') as fsrc:
+        size = os.fstat(fsrc.fileno()).st_size
+        try:
+            with open(tmp, 'xb') as fdst:
+                copied = copy_data(fsrc.fileno(), fdst.fileno(), size)
+                if copied < size:
+                    # fallback for filesystems not supported by the kernel calls
+                    fsrc.seek(copied)
+                    fdst.seek(copied)
+                    shutil.copyfileobj(fsrc, fdst, 1024*1024)
 
+            shutil.copystat(src, tmp)
+            try:
+                st = os.stat(src)
+                os.chown(tmp, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
 
-if __name__ == '__main__':
-    if "-h" in sys.argv[1:] or "--help" in sys.argv[1:]:
-        help()
+            os.replace(tmp, dst)
+        except:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    return size
+
+
+def update_file(src, dst, blocksize=1024*1024):
+    """
+    Rewrite in place only blocks of dst which differ from src, then
+    truncate dst to size of src and copy metadata.  Returns number of
+    bytes written.  Unlike copy_file it's not atomic.
+    """
+    import shutil
+
+    buf1  = bytearray(blocksize)
+    buf2  = bytearray(blocksize)
+    view1 = memoryview(buf1)
+    view2 = memoryview(buf2)
+
+    written = 0
+    offset  = 0
+    with open(src, 'rb', buffering=0) as fsrc, open(dst, 'r+b', buffering=0) as fdst:
+        while True:
+            n = fsrc.readinto(buf1)
+            if not n:
+                break
+
+            m = fdst.readinto(buf2)
+            if m != n or view1[:n] != view2[:n]:
+                fdst.seek(offset)
+                fdst.write(view1[:n])
+                written += n
+
+            offset += n
+
+        fdst.truncate(offset)
+
+    shutil.copystat(src, dst)
+    try:
+        st = os.stat(src)
+        os.chown(dst, st.st_uid, st.st_gid)
+    except PermissionError:
+        pass
+
+    return written
+
+
+def copy_data(fdin, fdout, size):
+    "copy data between file descriptors in the kernel, returns number of bytes copied"
+    import errno
 
-    if len(sys.argv) != 4:
-        help(1)
+    unsupported = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                n = os.copy_file_range(fdin, fdout, size - copied)
+                if n == 0:
+                    return copied
+                copied += n
 
-    M = sys.argv[1]
-    if M not in ['d', 's']:
-        help(2)
+            return copied
+        except OSError as e:
+            if e.errno not in unsupported:
+                raise
+
+    if hasattr(os, 'sendfile'):
+        try:
+            while copied < size:
+                n = os.sendfile(fdout, fdin, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in unsupported:
+                raise
+
+    return copied
+
+
+class CompareExecute(CompareBase):
+    """
+    make mirror of first directory in the second one: operations are done
+    in order mkdir, copy, rm, rmdir; files are copied by jobs threads
+    """
+
+    dry_run = False
+
+    # existing files of at least delta_size bytes are updated in place,
+    # only blocks that differ are written
+    delta_size = None
+
+    def __init__(self, listing1, listing2):
+        CompareBase.__init__(self, listing1, listing2)
+
+    def on_compare_start(self):
+        import time
+        from collections import deque
+
+        self.mkdirs  = []
+        self.mvfiles = []
+        self.cpfiles = []
+        self.rmfiles = []
+        self.rmdirs  = []
+
+        self.copied  = 0        # bytes
+        self.files   = 0
+        self.errors  = 0
+        self.started = time.monotonic()
+
+        self.pending = deque()
+        if self.jobs > 1 and not self.dry_run:
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(self.jobs)
+        else:
+            self.executor = None
+
+    def on_compare(self, path, kind, result):
+        if result == CompareBase.SAME:
+            return
+
+        if kind not in ['d', 'f']:
+            raise AssertionError("Unknown kind of path ('%s')" % kind)
+
+        if result in [CompareBase.SIZEDIFF, CompareBase.CONTENTDIFF,
+                      CompareBase.YOUNGER, CompareBase.OLDER]:
+            if kind == 'f':
+                self.__add(self.cpfiles, self.__copy, path)
+        elif result == CompareBase.MISSING2:
+            if kind == 'f':
+                self.__add(self.cpfiles, self.__copy, path)
+            elif kind == 'd':
+                self.__add(self.mkdirs, self.__mkdir, path)
+        elif result == CompareBase.MISSING1:
+            if kind == 'f':
+                self.__add(self.rmfiles, self.__rm, path)
+            elif kind == 'd':
+                self.__add(self.rmdirs, self.__rmdir, path)
+
+    def __add(self, list, operation, path):
+        # in streaming mode operations come in a safe order
+        if self.stream:
+            operation(path)
+        else:
+            list.append(path)
+
+    def on_compare_end(self):
+        import time
+
+        for path in self.mkdirs:
+            self.__mkdir(path)
+        for path1, path2 in self.mvfiles:
+            self.__move(path1, path2)
+        for path in self.cpfiles:
+            self.__copy(path)
+        self.__wait()
+        for path in self.rmfiles:
+            self.__rm(path)
+        # compare doesn't report directories in post-order
+        for path in sorted(self.rmdirs, reverse=True):
+            self.__rmdir(path)
+
+        self.__wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+        elapsed = time.monotonic() - self.started
+        if self.dry_run:
+            sys.stderr.write("%d files, %d bytes to copy\n" % (self.files, self.copied))
+        else:
+            sys.stderr.write("copied %d files, %d bytes written in %0.1f s (%0.1f MB/s), %d errors\n" % (
+                self.files, self.copied, elapsed, self.copied / max(elapsed, 1e-6) / 1e6, self.errors))
+
+    def on_move(self, path1, path2, kind):
+        self.mvfiles.append((path1, path2))
+
+    def __move(self, path1, path2):
+        from os.path import join
+
+        src = join(self.dir2.rootdir, path2)
+        dst = join(self.dir2.rootdir, path1)
+        if self.dry_run:
+            print('move "%s" "%s"' % (src, dst))
+        else:
+            self.__run(os.rename, src, dst)
+
+    def __run(self, function, *args):
+        try:
+            return function(*args)
+        except OSError as e:
+            sys.stderr.write("%s\n" % e)
+            self.errors += 1
+
+    def __mkdir(self, path):
+        import shutil
+        from os.path import join
+
+        src = join(self.dir1.rootdir, path)
+        dst = join(self.dir2.rootdir, path)
+        if self.dry_run:
+            print('mkdir "%s"' % dst)
+            return
+
+        self.__run(os.makedirs, dst, 0o777, True)
+        self.__run(shutil.copymode, src, dst)
+
+    def __copy(self, path):
+        from os.path import join, getsize
+
+        src = join(self.dir1.rootdir, path)
+        dst = join(self.dir2.rootdir, path)
+
+        copy = copy_file
+        if self.delta_size is not None and os.path.isfile(dst):
+            size = self.__run(getsize, src)
+            if size is not None and size >= self.delta_size:
+                copy = update_file
+
+        if self.dry_run:
+            size = self.__run(getsize, src) or 0
+            if copy is update_file:
+                print('update "%s" "%s" (at most %d bytes)' % (src, dst, size))
+            else:
+                print('copy "%s" "%s" (%d bytes)' % (src, dst, size))
+            self.__copied(src, dst, size)
+            return
+
+        if self.executor is None:
+            self.__copied(src, dst, self.__run(copy, src, dst))
+            return
+
+        self.pending.append((src, dst, self.executor.submit(copy, src, dst)))
+        while len(self.pending) > 4 * self.jobs:
+            self.__retire()
+
+    def __retire(self):
+        src, dst, future = self.pending.popleft()
+        self.__copied(src, dst, self.__run(future.result))
+
+    def __copied(self, src, dst, size):
+        if size is not None:
+            self.files  += 1
+            self.copied += size
+            if self.checksum is not None and not self.dry_run:
+                self.__run(self.__copy_sum, src, dst)
+
+    def __copy_sum(self, src, dst):
+        # the copy has the contents of source: its cached sum is valid for
+        # the copy too, which otherwise would be read again by next compare
+        sum = self.checksum.get(make_entry(None, 'f', os.stat(src)))
+        if sum is not None:
+            self.checksum.set(make_entry(None, 'f', os.stat(dst)), sum)
+
+    def __wait(self):
+        while self.pending:
+            self.__retire()
+
+    def __rm(self, path):
+        from os.path import join
+
+        dst = join(self.dir2.rootdir, path)
+        if self.dry_run:
+            print('rm "%s"' % dst)
+        else:
+            self.__run(os.unlink, dst)
+
+    def __rmdir(self, path):
+        from os.path import join
+
+        dst = join(self.dir2.rootdir, path)
+        if self.dry_run:
+            print('rmdir "%s"' % dst)
+        else:
+            self.__run(os.rmdir, dst)
+
+
+def parse_args(args):
+    from optparse import OptionParser
+
+    usage = """%prog [options] M directory1 directory2
+
+ M is method of compare result presentation:
+ d - print simple description
+ s - print shell script that makes mirr of of dir1 in dir2
+ x - make mirror of dir1 in dir2 (see --dry-run)"""
+
+    parser = OptionParser(usage=usage)
+
+    def add_rule(option, opt_str, value, parser, prefix):
+        parser.values.rules.append(prefix + value)
+
+    parser.add_option("-e", "--exclude", metavar="PATTERN", type="string",
+                      action="callback", callback=add_rule, callback_args=("",),
+                      help="skip files and directories matching gitignore-like PATTERN")
+    parser.add_option("-i", "--include", metavar="PATTERN", type="string",
+                      action="callback", callback=add_rule, callback_args=("!",),
+                      help="don't skip paths matching PATTERN; the last matching "
+                           "--exclude/--include wins")
+    parser.add_option("--ignore-file", metavar="NAME", dest="ignore_file",
+                      help="read more rules from files NAME (e.g. .gitignore) found in directories")
+    parser.set_defaults(rules=[])
+    parser.add_option("-c", "--checksum", dest="checksum", action="store_true", default=False,
+                      help="compare contents of files having the same size")
+    parser.add_option("-j", "--jobs", metavar="N", dest="jobs", type="int", default=4,
+                      help="calculate checksums or copy files (x) in N parallel threads [default: %default]")
+    parser.add_option("--delta", metavar="SIZE", dest="delta_size", type="int",
+                      help="update changed files of at least SIZE bytes in place: only changed "
+                           "blocks are written (x) or rsync is used (s)")
+    parser.add_option("-n", "--dry-run", dest="dry_run", action="store_true", default=False,
+                      help="with method x just print what would be done")
+    parser.add_option("-m", "--moves", dest="moves", action="store_true", default=False,
+                      help="detect files moved or renamed in directory1 (same size and mtime, "
+                           "and contents with --checksum) and move them in directory2")
+    parser.add_option("--stream", dest="stream", action="store_true", default=False,
+                      help="walk both trees at once and report differences immediately, "
+                           "in bounded memory (--scan-jobs is not used)")
+    parser.add_option("--snapshot", metavar="FILE", dest="snapshot",
+                      help="keep listing of directory2 in FILE; next time only directories "
+                           "with changed mtime are read again")
+    parser.add_option("--trust-mtime", dest="trust_mtime", action="store_true", default=False,
+                      help="with --snapshot assume files of unchanged directories are unchanged, "
+                           "don't stat them")
+    parser.add_option("--scan-jobs", metavar="N", dest="scan_jobs", type="int", default=1,
+                      help="read directories of each tree in N parallel threads [default: %default]")
+
+    (options, args) = parser.parse_args(args)
+    if len(args) != 3:
+        parser.error("method and two directories are required")
+
+    if args[0] not in ['d', 's', 'x']:
+        parser.error("unknown method '%s'" % args[0])
+
+    if options.moves and options.stream:
+        parser.error("option --moves can't be used with --stream")
+
+    if options.snapshot and options.stream:
+        parser.error("option --snapshot can't be used with --stream")
+
+    if options.delta_size is not None and options.delta_size < 0:
+        parser.error("delta size can't be negative")
+
+    if options.jobs < 1 or options.scan_jobs < 1:
+        parser.error("number of jobs must be positive")
+
+    try:
+        Rules(options.rules)
+    except ValueError as e:
+        parser.error(str(e))
+
+    return options, args
+
+
+def open_checksum_cache():
+    "checksums are kept in ~/.local/share/cmpdirs.py/cache.sqlite, or in memory"
+    from pathlib import Path
+
+    try:
+        root = Path.home() / ".local" / "share" / "cmpdirs.py"
+        root.mkdir(parents=True, exist_ok=True)
+        return ChecksumCache(root / "cache.sqlite")
+    except Exception as e:
+        sys.stderr.write("Can't open checksum cache: %s\n" % e)
+        return ChecksumCache(":memory:")
+
+
+if __name__ == '__main__':
+    options, (M, dir1, dir2) = parse_args(sys.argv[1:])
 
-    dir1 = sys.argv[2]
-    dir2 = sys.argv[3]
     if not os.path.exists(dir1):
         sys.stderr.write("'%s' is not a directory" % dir1)
     if not os.path.isdir(dir1):
@@ -267,13 +1482,63 @@ if __name__ == '__main__':
 
     l1 = DirectoryList(dir1)
     l2 = DirectoryList(dir2)
-    l1.scan()
-    l2.scan()
+    if options.rules or options.ignore_file:
+        l1.filter = Filter(l1.rootdir, options.rules, options.ignore_file)
+        l2.filter = Filter(l2.rootdir, options.rules, options.ignore_file)
+    if options.snapshot:
+        run_at_once([
+            lambda: l1.scan(options.scan_jobs),
+            lambda: scan_with_snapshot(l2, options.snapshot, options.scan_jobs, options.trust_mtime),
+        ])
+    elif not options.stream:
+        run_at_once([
+            lambda: l1.scan(options.scan_jobs),
+            lambda: l2.scan(options.scan_jobs),
+        ])
 
     if M == 'd':
         Cmp = CompareDescription(l1, l2)
     elif M == 's':
         Cmp = CompareShell(l1, l2)
+        Cmp.delta_size = options.delta_size
+    elif M == 'x':
+        Cmp = CompareExecute(l1, l2)
+        Cmp.dry_run = options.dry_run
+        Cmp.delta_size = options.delta_size
+
+    Cmp.jobs = options.jobs
+    Cmp.detect_moves = options.moves
+    if options.checksum:
+        Cmp.checksum = open_checksum_cache()
+
+    if options.snapshot:
+        # paths that are (or will be) changed by mirror are read again next time
+        report_compare, report_move = Cmp.on_compare, Cmp.on_move
+
+        def on_compare(path, kind, result):
+            if result != CompareBase.SAME:
+                l2.invalidate(path)
+            report_compare(path, kind, result)
+
+        def on_move(path1, path2, kind):
+            l2.invalidate(path1)
+            l2.invalidate(path2)
+            report_move(path1, path2, kind)
+
+        Cmp.on_compare, Cmp.on_move = on_compare, on_move
+
+    try:
+        if options.stream:
+            Cmp.compare_stream()
+        else:
+            Cmp.compare()
+    finally:
+        if Cmp.checksum is not None:
+            Cmp.checksum.close()
+
+    if options.snapshot:
+        l2.save(options.snapshot)
 
-    Cmp.compare()
+    if M == 'x' and Cmp.errors:
+        sys.exit(1)
 #
@@ -4,14 +4,15 @@
 # Find duplicated files. Just a list of duplicated is
 # created, no files are deleted, nor moved.
 #
-# Progam works in 3 steps: first group files of same size,
-# then group them by contents first 4kB, and finally calculate
-# md5 checksum for selected files.
+# Progam works in steps: first group files of same size,
+# then group them by contents of first 4kB, last 4kB and
+# blocks sampled at growing offsets (see --stages), and
+# finally calculate checksum (md5 by default) for selected files.
 #
-# Program creates two files: removedups.md5cache and
-# removedups.md5headcache, which store calculated checksum;
-# these files can by reused later, making comparision much
-# faster. However you are free to remove them.
+# Program keeps calculated checksums in a SQLite database
+# ~/.local/share/finddups.py/cache.sqlite; checksums are reused
+# later, making comparision much faster. However you are free
+# to remove the file.
 #
 # Author: Wojciech Muła
 # e-mail: wojciech_mula@poczta.onet.pl
@@ -19,12 +20,18 @@
 #
 # License: public domain
 
-import os, sys
+import os, sys, time, errno
 
-from os.path import isdir, islink, exists, getsize, getmtime
+from os.path import isdir, exists
 from os.path import abspath, dirname, normpath, join
-from hashlib import md5
+from array import array
+from collections import namedtuple
+from functools import partial
 from pathlib import Path
+import hashlib
+import itertools
+import json
+import threading
 
 def parse_args(args):
     # define options
@@ -33,14 +40,23 @@ def parse_args(args):
     parser = OptionParser("usage: %prog [options] list-of-directories")
     parser.add_option("-s", action="store_true", dest="shell", default=False,
                       help="create shell script that remove dups")
+    parser.add_option("--dedupe", metavar="METHOD", dest="dedupe", default=None,
+                      help="make duplicates share data: 'hardlink' replaces them with hardlinks, "
+                           "'reflink' shares extents (on btrfs, XFS and other filesystems supporting it)")
     parser.add_option("-o", "--out", metavar="FILE", dest="log_file", default=None,
                       help="log file name, if ommited stdout is user")
+    parser.add_option("--format", metavar="FORMAT", dest="format", default="text",
+                      help="output format: text, jsonl (JSON object per group) or null (paths "
+                           "terminated by NUL, an extra NUL after each group) [default: %default]")
     parser.add_option("--sep", dest="separator", default="\n\t",
                       help="seperator for duplicated entries; use \\n for newline, \\t for tab [default: \\n\\t]")
     parser.add_option("--sort", action="store_true", dest="sort", default=False,
                       help="sort filenames in log")
     parser.add_option("-q", "--quote", action="store_true", dest="quote", default=False,
                       help="quote paths with \" if contain space")
+    parser.add_option("--hardlinks", metavar="FILE", dest="hardlinks_file", default=None,
+                      help="save groups of hardlinks (paths to the same file) in FILE; only one path "
+                           "of such group is considered when looking for duplicates")
     parser.add_option("-a", "--abs-path", action="store_true", dest="abspath", default=False,
                       help="save absolute paths")
     parser.add_option("-e", "--exclude", action="append", dest="exclude",
@@ -51,6 +67,58 @@ def parse_args(args):
                       help="do not overwrite log file if exists")
     parser.add_option("--no-recursive", dest="no_recursive", action="store_true", default=False,
                       help="do not go deeper")
+    parser.add_option("--make-reference", metavar="INDEX", dest="make_reference", default=None,
+                      help="save sizes and checksums of all files from directories in INDEX file, "
+                           "and exit; the index is used by --reference")
+    parser.add_option("--reference", metavar="INDEX", dest="reference", default=None,
+                      help="find files from directories that exist in INDEX (made by --make-reference), "
+                           "without scanning indexed directories")
+    parser.add_option("--similar-images", metavar="FILE", dest="similar_images", default=None,
+                      help="write groups of similar images (JPEG, PNG) to FILE, in the output format; "
+                           "requires numpy and Pillow")
+    parser.add_option("--image-hash", metavar="NAME", dest="image_hash", default="dhash",
+                      help="perceptual hash used by --similar-images: dhash or phash [default: %default]")
+    parser.add_option("--similar-threshold", metavar="BITS", dest="similar_threshold", type="int", default=8,
+                      help="max number of different bits of hashes of similar images [default: %default]")
+    parser.add_option("--stages", metavar="LIST", dest="stages", default="head,tail,samples",
+                      help="comma-separated list of partial comparisons done before full checksum: %s [default: %%default]" %
+                           ", ".join(partial_stages))
+    parser.add_option("--hash", metavar="NAME", dest="algorithm", default="md5",
+                      help="checksum algorithm: %s [default: %%default]" % ", ".join(hash_algorithms))
+    parser.add_option("--buffer-size", metavar="BYTES", dest="bufsize", type="int", default=1024*1024,
+                      help="size of read buffer used for full checksums [default: %default]")
+    parser.add_option("--benchmark", dest="benchmark", action="store_true", default=False,
+                      help="print speed of available checksum algorithms and exit")
+    parser.add_option("--compare", dest="compare", action="store_true", default=False,
+                      help="instead of calculating full checksums compare files byte by byte")
+    parser.add_option("--chunk-size", metavar="BYTES", dest="chunksize", type="int", default=65536,
+                      help="size of chunks read by --compare [default: %default]")
+    parser.add_option("--max-open", metavar="N", dest="max_open", type="int", default=64,
+                      help="max number of files kept opened by --compare [default: %default]")
+    parser.add_option("--benchmark-scan", dest="benchmark_scan", action="store_true", default=False,
+                      help="compare speed of scanning directories with os.walk and os.scandir, and exit")
+    parser.add_option("--scan-jobs", metavar="N", dest="scan_jobs", type="int", default=1,
+                      help="read directories in N parallel threads [default: %default]")
+    parser.add_option("-j", "--jobs", metavar="N", dest="jobs", type="int", default=1,
+                      help="calculate checksums in N parallel threads [default: %default]")
+    parser.add_option("--processes", dest="processes", action="store_true", default=False,
+                      help="calculate full checksums in a pool of processes rather than threads (with --jobs)")
+    parser.add_option("--drop-cache", dest="drop_cache", action="store_true", default=False,
+                      help="drop hashed files from the page cache (posix_fadvise DONTNEED); "
+                           "note that pages cached by other programs are dropped too")
+    parser.add_option("--io-order", metavar="ORDER", dest="io_order", default="none",
+                      help="read files in on-disk order: none, inode or fiemap (physical offset); "
+                           "with --jobs each device gets own N threads [default: %default]")
+    parser.add_option("--checkpoint-files", metavar="N", dest="checkpoint_files", type="int", default=1000,
+                      help="save calculated checksums after each N files [default: %default]")
+    parser.add_option("--checkpoint-seconds", metavar="T", dest="checkpoint_seconds", type="float", default=30.0,
+                      help="save calculated checksums at least every T seconds [default: %default]")
+    parser.add_option("--resume", dest="resume", action="store_true", default=False,
+                      help="continue interrupted run from the last completed stage, without scanning directories")
+    parser.add_option("--stats", dest="stats", action="store_true", default=False,
+                      help="print time and amount of data read by each stage, and cache hit ratios")
+    parser.add_option("--profile", metavar="FILE", dest="profile", default=None,
+                      help="save cProfile statistics of the run in FILE")
     parser.add_option("--traceback", dest="print_traceback", action="store_true", default=False,
                       help="in case of error print full traceback, that can help identify an error")
 
@@ -65,26 +133,87 @@ def parse_args(args):
     if options.exclude is None:
         options.exclude = []
 
+    if options.format not in ('text', 'jsonl', 'null'):
+        parser.error("unknown output format '%s'" % options.format)
+
+    if options.dedupe not in (None, 'hardlink', 'reflink'):
+        parser.error("unknown deduplication method '%s'" % options.dedupe)
+
+    if options.reference and options.make_reference:
+        parser.error("options --reference and --make-reference are mutually exclusive")
+
+    if options.reference and not exists(options.reference):
+        parser.error("index %s doesn't exist" % options.reference)
+
+    if options.dedupe and (options.reference or options.make_reference):
+        parser.error("option --dedupe can't be used with reference index")
+
+    if options.similar_images:
+        if numpy is None:
+            parser.error("option --similar-images requires numpy and Pillow")
+        if options.image_hash not in ('dhash', 'phash'):
+            parser.error("unknown image hash '%s'" % options.image_hash)
+        if options.reference or options.make_reference:
+            parser.error("option --similar-images can't be used with reference index")
+        if exists(options.similar_images) and not options.overwrite:
+            parser.error("File %s already exists." % options.similar_images)
+
+    if options.shell and options.format != 'text':
+        parser.error("option -s can be used only with text format")
+
+    if options.jobs < 1 or options.scan_jobs < 1:
+        parser.error("number of jobs must be positive")
+
+    if options.io_order not in ('none', 'inode', 'fiemap'):
+        parser.error("unknown I/O order '%s'" % options.io_order)
+
+    if options.algorithm not in hash_algorithms:
+        parser.error("checksum algorithm '%s' is not available" % options.algorithm)
+
+    if options.chunksize < 1 or options.max_open < 2:
+        parser.error("chunk size must be positive and at least two files must be opened")
+
+    if options.bufsize < 4096:
+        parser.error("buffer size must be at least 4096 bytes")
+
+    if options.benchmark:
+        benchmark(options.bufsize, sys.stdout)
+        raise SystemExit
+
+    options.stages = [name.strip() for name in options.stages.split(",") if name.strip()]
+    for name in options.stages:
+        if name not in partial_stages:
+            parser.error("unknown stage '%s'" % name)
+
     options.separator = options.separator.replace("\\n", '\n').replace("\\t", '\t')
 
-    tmp = set()
     directories = []
     for dir in rest[1:]:
-        path = normpath(abspath(dir))
-        if path in tmp:
-            continue
-
-        if not exists(path):
+        if not exists(dir):
             parser.error("'%s' doesn't exists" % dir)
-        elif not isdir(path):
+        elif not isdir(dir):
             parser.error("'%s' is not a directory" % dir)
         else:
             directories.append(dir)
 
+    # a directory given twice, or inside another one, would be scanned twice
+    # and its files reported as duplicates of themselves
+    def nested(i, j):
+        "directory i is inside directory j, or is the same as earlier j"
+        return real[i].startswith(real[j]) and (real[i] != real[j] or j < i)
+
+    real = [join(os.path.realpath(dir), '') for dir in directories]
+    directories = [dir for i, dir in enumerate(directories)
+                   if not any(nested(i, j) for j in range(len(directories)) if j != i)]
+
     if not directories:
         parser.print_help()
         raise SystemExit
 
+    if options.benchmark_scan:
+        benchmark_scan(directories, sys.stdout)
+        raise SystemExit
+
     return (options, directories)
 
 
@@ -100,71 +229,1309 @@ class Dict(dict):
         L.append(value)
 
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+# name => constructor of hash object
+hash_algorithms = {
+    'md5'    : hashlib.md5,
+    'sha1'   : hashlib.sha1,
+    'blake2b': hashlib.blake2b,
+}
+
+if xxhash is not None:
+    hash_algorithms['xxh3'] = xxhash.xxh3_128
+
+if blake3 is not None:
+    hash_algorithms['blake3'] = blake3.blake3
+
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+    Image = None
+
+
+# read buffers are reused by all calls made in a thread
+buffers = threading.local()
+
+def get_buffer(bufsize):
+    buf = getattr(buffers, 'buf', None)
+    if buf is None or len(buf) != bufsize:
+        buf = buffers.buf = bytearray(bufsize)
+
+    return buf
+
+
+def fadvise(file, *advice):
+    "hints for the page cache (SEQUENTIAL, RANDOM...), ignored where not supported"
+    if hasattr(os, 'posix_fadvise'):
+        for name in advice:
+            try:
+                os.posix_fadvise(file.fileno(), 0, 0, getattr(os, 'POSIX_FADV_' + name))
+            except (AttributeError, OSError):
+                pass
+
+
+def calc_full(filename, algorithm='md5', bufsize=1024*1024, drop_cache=False):
+    """
+    checksum of the whole file; with drop_cache its pages are removed
+    from the page cache afterwards, also if they were cached before
+    """
+    buf  = get_buffer(bufsize)
+    view = memoryview(buf)
+    sum  = hash_algorithms[algorithm]()
+    with open(filename, 'rb', buffering=0) as file:
+        # file is read once: full readahead, pages not worth keeping
+        fadvise(file, 'SEQUENTIAL', 'NOREUSE')
+        while True:
+            n = file.readinto(buf)
+            if not n:
+                break
+            sum.update(view[:n])
+        if drop_cache:
+            fadvise(file, 'DONTNEED')
+
+    return sum.digest()
+
+
+def calc_head(filename, algorithm='md5', bufsize=4096):
+    "checksum of first bufsize bytes of file"
+    sum = hash_algorithms[algorithm]()
+    with open(filename, 'rb', buffering=0) as file:
+        fadvise(file, 'RANDOM')    # no readahead for a single block
+        sum.update(file.read(bufsize))
+
+    return sum.digest()
+
+
+def calc_tail(filename, algorithm='md5', bufsize=4096):
+    "checksum of last bufsize bytes of file"
+    sum = hash_algorithms[algorithm]()
+    with open(filename, 'rb', buffering=0) as file:
+        fadvise(file, 'RANDOM')
+        size = os.fstat(file.fileno()).st_size
+        file.seek(max(0, size - bufsize))
+        sum.update(file.read(bufsize))
+
+    return sum.digest()
+
+
+def calc_samples(filename, algorithm='md5', bufsize=4096, first=65536):
+    """
+    checksum of blocks of bufsize bytes, read at offsets first, 2*first,
+    4*first, 8*first and so on; for 1GB file 15 blocks are read
+    """
+    sum = hash_algorithms[algorithm]()
+    with open(filename, 'rb', buffering=0) as file:
+        fadvise(file, 'RANDOM')
+        size   = os.fstat(file.fileno()).st_size
+        offset = first
+        while offset < size:
+            file.seek(offset)
+            sum.update(file.read(bufsize))
+            offset *= 2
+
+    return sum.digest()
+
+
+def benchmark(bufsize, out, total=256*1024*1024):
+    "print speed of available hash algorithms, hashing data from memory"
+    buf  = os.urandom(bufsize)
+    view = memoryview(buf)
+    for name, constructor in hash_algorithms.items():
+        sum = constructor()
+        t0  = time.perf_counter()
+        n   = 0
+        while n < total:
+            sum.update(view)
+            n += bufsize
+        sum.digest()
+        t = time.perf_counter() - t0
+
+        out.write("%-8s %8.1f MB/s\n" % (name, n / t / 1e6))
+
+
+def open_cache(filename):
+    "open (or create) SQLite database that keeps checksums between runs"
+    import sqlite3
+
+    # other runs write to the same cache, in short transactions
+    db = sqlite3.connect(str(filename), timeout=60.0)
+    # WAL journal: committed batches survive a crash, and commits are cheap
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+
+    # tables written by older versions are dropped
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version != CACHE_VERSION:
+        tables = db.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+        for (table,) in tables:
+            db.execute("DROP TABLE %s" % table)
+        db.execute("PRAGMA user_version=%d" % CACHE_VERSION)
+        db.commit()
+
+    return db
+
+
+CACHE_VERSION = 2
+
+
 class Md5Cache:
-    "cache for md5 sums of files; md5 sum is recalculated when modification time changed"
+    """
+    cache for checksums of files, stored in a SQLite table; a row is
+    identified by (device, inode, algorithm) and is valid as long as
+    size and modification time of file didn't change
+    """
+
+    table = "md5"
+    calc  = staticmethod(calc_full)
+
+    def __init__(self, db, algorithm='md5', bufsize=None, batch=1000, interval=30.0):
+        self.db       = db
+        self.algorithm = algorithm
+        self.batch    = batch       # number of new sums written in one transaction
+        self.interval = interval    # max time (in seconds) between transactions
+        self.rows     = []          # new sums, not written yet
+        self.last_flush = time.monotonic()
+
+        # statistics
+        self.hits       = 0
+        self.misses     = 0
+        self.bytes      = 0     # bytes read to calculate missing sums
+        self.flush_time = 0.0
+
+        # a partial of module-level function, so it can be sent to worker processes
+        if bufsize is None:
+            self.calc_sum = partial(self.calc, algorithm=algorithm)
+        else:
+            self.calc_sum = partial(self.calc, algorithm=algorithm, bufsize=bufsize)
+
+        db.execute("""CREATE TABLE IF NOT EXISTS %s (
+                          dev       INTEGER,
+                          ino       INTEGER,
+                          algorithm TEXT,
+                          size      INTEGER,
+                          mtime_ns  INTEGER,
+                          sum       BLOB,
+                          PRIMARY KEY (dev, ino, algorithm)
+                      ) WITHOUT ROWID""" % self.table)
+
+        self.select_sql = "SELECT sum FROM %s WHERE dev=? AND ino=? AND algorithm=? AND size=? AND mtime_ns=?" % self.table
+        self.insert_sql = "INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?)" % self.table
+
+    def get_sum(self, info):
+        key, sum = self.lookup(info)
+        if sum is None:
+            sum = self.calc_sum(info.path)
+            self.store(key, sum)
+
+        return sum
+
+    def lookup(self, info):
+        "returns (key, sum) for FileInfo; sum is None if not cached"
+        key = (info.dev, info.ino, self.algorithm, info.size, info.mtime_ns)
+
+        row = self.db.execute(self.select_sql, key).fetchone()
+        if row is not None:
+            self.hits += 1
+            return (key, row[0])
+
+        self.misses += 1
+        return (key, None)
+
+    def bytes_read(self, size):
+        "number of bytes read to calculate sum of file of given size"
+        return size
+
+    def splits(self, size, previous=()):
+        """
+        False if sums can't split a group of files of given size, after
+        partial stages previous (names) have run; the stage is skipped then
+        """
+        return True
+
+    def store(self, key, sum):
+        self.rows.append(key + (sum,))
+        self.bytes += self.bytes_read(key[3])
+        if len(self.rows) >= self.batch or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        write sums calculated so far in one short transaction, so that the
+        database is not locked for other runs in between; when it fails
+        (e.g. the database is locked for too long) the sums are not cached,
+        the error is reported and the run goes on
+        """
+        import sqlite3
+
+        t0 = time.monotonic()
+        rows, self.rows = self.rows, []
+        try:
+            with self.db:
+                self.db.executemany(self.insert_sql, rows)
+        except sqlite3.Error as e:
+            sys.stderr.write("Can't save %d checksums in cache: %s\n" % (len(rows), e))
+
+        self.last_flush = time.monotonic()
+        self.flush_time += self.last_flush - t0
+
+
+class Md5ShortCache(Md5Cache):
+    "cache for checksums of first 4kB of files"
+    table = "md5head"
+    calc  = staticmethod(calc_head)
+
+    def bytes_read(self, size):
+        return min(size, 4096)
+
+
+class Md5TailCache(Md5Cache):
+    "cache for checksums of last 4kB of files"
+    table = "md5tail"
+    calc  = staticmethod(calc_tail)
+
+    def bytes_read(self, size):
+        return min(size, 4096)
+
+    def splits(self, size, previous=()):
+        # the last 4kB of a small file are the bytes head has hashed
+        return size > 4096 or 'head' not in previous
+
+
+class Md5SamplesCache(Md5Cache):
+    "cache for checksums of blocks sampled at exponentially growing offsets"
+    table = "md5samples"
+    calc  = staticmethod(calc_samples)
+
+    def bytes_read(self, size):
+        n = 0
+        offset = 65536
+        while offset < size:
+            n += min(size - offset, 4096)
+            offset *= 2
+
+        return n
+
+    def splits(self, size, previous=()):
+        return self.bytes_read(size) > 0
+
+
+def dct_matrix(n):
+    "matrix of orthonormal DCT-II of size n"
+    k = numpy.arange(n).reshape(n, 1)
+    i = numpy.arange(n).reshape(1, n)
+    m = numpy.cos(numpy.pi * (2*i + 1) * k / (2*n)) * numpy.sqrt(2.0 / n)
+    m[0] /= numpy.sqrt(2.0)
+    return m
+
+
+def calc_image_hash(filename, algorithm='dhash'):
+    """
+    64-bit perceptual hash of image, as 8 bytes:
+
+    - dhash: image scaled to 9x8 greyscale pixels, a bit tells if
+      a pixel is brighter than its right neighbour;
+    - phash: 8x8 lowest frequencies of DCT of image scaled to 32x32
+      greyscale pixels, a bit tells if a coefficient is above median.
+    """
+    with Image.open(filename) as image:
+        image = image.convert('L')
+        if algorithm == 'dhash':
+            pixels = numpy.asarray(image.resize((9, 8), Image.LANCZOS), dtype=numpy.int16)
+            bits   = pixels[:, 1:] > pixels[:, :-1]
+        else:
+            pixels = numpy.asarray(image.resize((32, 32), Image.LANCZOS), dtype=numpy.float64)
+            dct    = dct_matrix(32)
+            low    = (dct @ pixels @ dct.T)[:8, :8]
+            bits   = low > numpy.median(low.ravel()[1:])    # DC term is skipped
+
+    return numpy.packbits(bits.ravel()).tobytes()
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of integers in Hamming space; finding values
+    within given distance visits only a small part of tree
+    """
+
     def __init__(self):
-        self.cache = {}     # path => (mod. time, md5sum)
+        self.root = None    # [value, items, {distance: child}]
+
+    def add(self, value, item):
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
 
-    def get_sum(self, filename):
-        filename   = abspath(filename)
+        node = self.root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
 
-        file_mtime = getmtime(filename)
+            node = child
+
+    def search(self, value, radius):
+        "yields items of values within radius from value"
+        if self.root is None:
+            return
 
-        if filename in self.cache:
-            cache_mtime, sum = self.cache[filename]
-            if cache_mtime == file_mtime:
-                return sum
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= radius:
+                yield from node[1]
+
+            # triangle inequality: only children at distance d +/- radius may match
+            for distance, child in node[2].items():
+                if d - radius <= distance <= d + radius:
+                    stack.append(child)
 
-        sum = self.calc_sum(filename)
-        self.cache[filename] = (file_mtime, sum)
-        return sum
 
-    def calc_sum(self, filename):
-        file    = open(filename, 'rb')
-        bufsize = 8192
-        sum     = md5()
+def cluster_by_hash(items, radius):
+    """
+    Groups pairs (item, hash) into clusters, linking items whose
+    hashes differ at most on radius bits; returns lists of items of
+    clusters having more than one item.
+    """
+    tree   = BKTree()
+    parent = {}
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for item, value in items:
+        parent[item] = item
+        for other in tree.search(value, radius):
+            a, b = find(item), find(other)
+            if a != b:
+                parent[a] = b
+
+        tree.add(value, item)
+
+    clusters = Dict()
+    for item in parent:
+        clusters[find(item)] = item
+
+    return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+
+class ImageHashCache(Md5Cache):
+    "cache for perceptual hashes of images; algorithm is dhash or phash"
+    table = "imagehash"
+    calc  = staticmethod(calc_image_hash)
+
+    def bytes_read(self, size):
+        # image decoders read as much as they need, it's not known here;
+        # the stage is reported without the amount of data
+        return 0
+
+
+image_extensions = ('.jpg', '.jpeg', '.png')
+
+
+# stages run between grouping by size and by full MD5 sum:
+# name => (cache class, name of stage, status message)
+partial_stages = {
+    'head'   : (Md5ShortCache,   'group by first 4kB',      "read head of "),
+    'tail'   : (Md5TailCache,    'group by last 4kB',       "read tail of "),
+    'samples': (Md5SamplesCache, 'group by sampled blocks', "read blocks of "),
+}
+
+
+class ReferenceIndex:
+    """
+    SQLite database with size, checksum of first 4kB, full checksum,
+    path, device and inode of files from an archive
+    """
+
+    def __init__(self, filename, algorithm=None):
+        import sqlite3
+
+        self.db = sqlite3.connect(str(filename))
+        if algorithm is not None:
+            self.db.execute("CREATE TABLE meta (algorithm TEXT)")
+            self.db.execute("INSERT INTO meta VALUES (?)", (algorithm,))
+            self.db.execute("CREATE TABLE files (size INTEGER, head BLOB, sum BLOB, path TEXT, "
+                            "dev INTEGER, ino INTEGER)")
+
+        self.algorithm = self.db.execute("SELECT algorithm FROM meta").fetchone()[0]
+
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(files)")]
+        if 'ino' not in columns:
+            raise ValueError("index was made by an older version, make it again")
+
+    def add(self, size, head, sum, path, dev, ino):
+        self.db.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)", (size, head, sum, path, dev, ino))
+
+    def close(self):
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size, head, sum)")
+        self.db.commit()
+        self.db.close()
+
+    def has_size(self, size):
+        return self.db.execute("SELECT 1 FROM files WHERE size=? LIMIT 1", (size,)).fetchone() is not None
+
+    def has_head(self, size, head):
+        return self.db.execute("SELECT 1 FROM files WHERE size=? AND head=? LIMIT 1", (size, head)).fetchone() is not None
+
+    def find(self, size, sum):
+        "list of (path, dev, ino) of files having given size and checksum"
+        rows = self.db.execute("SELECT path, dev, ino FROM files WHERE size=? AND sum=?", (size, sum))
+        return rows.fetchall()
+
+
+def get_sums(cache, files, onerror, executor=None, window=1, getinfo=None):
+    """
+    Yields pairs (file, sum) in the same order as files are given;
+    getinfo extracts FileInfo from an item of files, if it's not a FileInfo.
+
+    Sums missing in the cache are calculated by the executor (a thread
+    or process pool), at most window files are processed at once.
+    Cache is accessed only from the calling thread.  When calculating
+    sum fails, onerror is called from the except block and the file
+    is skipped.
+    """
+    from collections import deque
+
+    if getinfo is None:
+        getinfo = lambda file: file
+
+    if executor is None:
+        for file in files:
+            try:
+                yield (file, cache.get_sum(getinfo(file)))
+            except KeyboardInterrupt:
+                raise
+            except:
+                onerror()
+
+        return
+
+    pending = deque()
+
+    def retire():
+        file, key, sum = pending.popleft()
+        try:
+            if sum is None:
+                return
+
+            if not isinstance(sum, bytes):
+                sum = sum.result()
+                cache.store(key, sum)
+
+            return (file, sum)
+        except KeyboardInterrupt:
+            raise
+        except:
+            onerror()
+
+    for file in files:
+        try:
+            info = getinfo(file)
+            key, sum = cache.lookup(info)
+            if sum is None:
+                if isinstance(executor, DeviceExecutors):
+                    sum = executor.submit_to(info.dev, cache.calc_sum, info.path)
+                else:
+                    sum = executor.submit(cache.calc_sum, info.path)
+        except KeyboardInterrupt:
+            raise
+        except:
+            onerror()
+            key = sum = None
+
+        pending.append((file, key, sum))
+        while len(pending) > window:
+            item = retire()
+            if item is not None:
+                yield item
+
+    while pending:
+        item = retire()
+        if item is not None:
+            yield item
+
+
+# ioctls from linux/fs.h
+FS_IOC_FIEMAP = 0xC020660B  # _IOWR('f', 11, struct fiemap)
+
+def physical_offset(filename):
+    "physical offset of the first extent of file, None if it's not known"
+    import fcntl, struct
+    # struct fiemap with space for one struct fiemap_extent (56 bytes)
+    arg = bytearray(struct.pack('=QQIIII', 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(56))
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, arg, True)
+        finally:
+            os.close(fd)
+    except OSError:
+        return None
+
+    mapped_extents, = struct.unpack_from('=I', arg, 20)
+    if not mapped_extents:
+        return None
+
+    physical, = struct.unpack_from('=Q', arg, 40)
+    return physical
+
+
+def io_order(files, getinfo, method='inode'):
+    """
+    Returns files sorted in on-disk order, by inode number or by physical
+    offset (method 'fiemap'), separately on each device. Lists of devices
+    are interleaved, so that all disks are kept busy.
+    """
+    devices = {}
+    for file in files:
+        info = getinfo(file)
+        if method == 'fiemap':
+            offset = physical_offset(info.path)
+            key = (0, offset) if offset is not None else (1, info.ino)
+        else:
+            key = info.ino
+
+        devices.setdefault(info.dev, []).append((key, file))
+
+    lists = [[file for key, file in sorted(items, key=lambda item: item[0])]
+             for items in devices.values()]
+
+    end = object()
+    return [file for files in itertools.zip_longest(*lists, fillvalue=end)
+                 for file in files if file is not end]
+
+
+class DeviceExecutors:
+    "a pool of threads per device, so that each disk has its own queue of reads"
+
+    def __init__(self, jobs):
+        self.jobs      = jobs
+        self.executors = {}
+
+    def submit_to(self, dev, fn, *args):
+        executor = self.executors.get(dev)
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = self.executors[dev] = ThreadPoolExecutor(self.jobs)
+
+        return executor.submit(fn, *args)
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown()
+
+
+FICLONE       = 0x40049409  # _IOW(0x94, 9, int)
+FIDEDUPERANGE = 0xC0189436  # _IOWR(0x94, 54, struct file_dedupe_range)
+
+FILE_DEDUPE_RANGE_DIFFERS = 1
+
+
+def temporary_path(path):
+    "name of not existing file in the same directory as path"
+    dir, name = os.path.split(path)
+    for i in range(1000):
+        tmp = join(dir, ".%s.finddups-%d-%d" % (name, os.getpid(), i))
+        if not os.path.lexists(tmp):
+            return tmp
+
+    raise FileExistsError("can't create temporary file for '%s'" % path)
+
+
+def dedupe_range(src, dst, size):
+    """
+    Share extents of src with dst using FIDEDUPERANGE; the kernel locks
+    both files and compares their contents itself.  Returns number of
+    bytes deduplicated.
+    """
+    import fcntl, struct
+
+    total = 0
+    with open(src, 'rb') as fsrc, open(dst, 'rb') as fdst:
+        while total < size:
+            length = min(size - total, 16*1024*1024)
+            arg = bytearray(struct.pack("QQHHI", total, length, 1, 0, 0) +
+                            struct.pack("qQQiI", fdst.fileno(), total, 0, 0, 0))
+            fcntl.ioctl(fsrc.fileno(), FIDEDUPERANGE, arg, True)
+
+            _, _, deduped, status, _ = struct.unpack_from("qQQiI", arg, 24)
+            if status < 0:
+                raise OSError(-status, os.strerror(-status), dst)
+            if status == FILE_DEDUPE_RANGE_DIFFERS:
+                raise ValueError("'%s' and '%s' differ" % (src, dst))
+            if deduped == 0:
+                break
+
+            total += deduped
+
+    return total
+
+
+def reflink(src, dst):
+    "atomically replace dst with clone of src (FICLONE), keeping metadata of dst"
+    import fcntl, shutil
+
+    tmp = temporary_path(dst)
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'xb') as ftmp:
+            fcntl.ioctl(ftmp.fileno(), FICLONE, fsrc.fileno())
+
+        st = os.stat(dst)
+        shutil.copystat(dst, tmp)
+        try:
+            os.chown(tmp, st.st_uid, st.st_gid)
+        except PermissionError:
+            pass
+
+        os.replace(tmp, dst)
+    except:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def hardlink(src, dst):
+    "atomically replace dst with hardlink to src"
+    tmp = temporary_path(dst)
+    os.link(src, tmp)
+    try:
+        os.replace(tmp, dst)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def dedupe_group(files, method, hardlinks, onerror, chunksize=65536, max_open=64):
+    """
+    Makes files (FileInfo) of a group of duplicates share data with the
+    first one, using method 'hardlink' or 'reflink'; hardlinks maps
+    (device, inode) to all paths of the inode.  Returns number of bytes
+    reclaimed.
+
+    Files changed since scan are skipped.  Contents are compared again
+    before files are replaced, except for FIDEDUPERANGE which compares
+    data in the kernel.
+    """
+    def unchanged(info):
+        st = os.stat(info.path)
+        return st.st_size == info.size and st.st_mtime_ns == info.mtime_ns and st.st_ino == info.ino
+
+    reclaimed = 0
+    try:
+        files = [info for info in files if unchanged(info)]
+    except KeyboardInterrupt:
+        raise
+    except:
+        onerror()
+        return 0
+
+    if method == 'hardlink':
+        groups = group_by_contents(files, onerror, chunksize, max_open)
+    else:
+        groups = [files]
+
+    for group in groups:
+        src = group[0]
+        for dst in group[1:]:
+            # all paths of dst inode must point to src to release its data
+            paths = hardlinks.get((dst.dev, dst.ino), [dst.path])
+            try:
+                if method == 'hardlink':
+                    if dst.dev != src.dev:
+                        continue
+
+                    for path in paths:
+                        hardlink(src.path, path)
+
+                    if len(paths) == dst.nlink:
+                        reclaimed += dst.size
+                else:
+                    try:
+                        reclaimed += dedupe_range(src.path, dst.path, dst.size)
+                    except OSError as e:
+                        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.EXDEV, errno.EPERM):
+                            raise
+
+                        # the filesystem can't deduplicate existing files, try to clone
+                        if group_by_contents([src, dst], onerror, chunksize, max_open) != [[src, dst]]:
+                            continue
+
+                        reflink(src.path, dst.path)
+                        if dst.nlink == 1:
+                            reclaimed += dst.size
+            except KeyboardInterrupt:
+                raise
+            except:
+                onerror()
+
+    return reclaimed
+
+
+def save_state(filename, state):
+    "atomically replace file with pickled state"
+    import pickle
+
+    tmp = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmp, "wb") as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp, filename)
+
+
+def load_state(filename):
+    import pickle
+
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+# file found by scan_tree(), along with data needed by caches
+FileInfo = namedtuple('FileInfo', 'path size mtime_ns dev ino nlink')
+
+
+class FileTable:
+    """
+    Compact storage of files found by scan: a directory is kept as its
+    name and index of its parent, names of files of a directory are kept
+    in one bytes object (separated by NULs, file has offset of its name),
+    and numeric attributes are stored in arrays; a file is identified by
+    its index in the table.
+
+    With unique=False files of sizes that appear just once are dropped
+    from the table by groups(), and the remaining files are reordered
+    so that each group of the same size is a range of indices.
+    """
+
+    def __init__(self, unique=True):
+        self.unique   = unique          # keep files of unique sizes
+        self.dir_parent = array('I')    # index of parent directory, NO_PARENT for roots
+        self.dir_name   = []            # name of directory, full path for roots
+        self.dir_files  = []            # names of files of directory, each ended by NUL
+        self.dir      = array('I')      # index of directory
+        self.name     = array('I')      # offset of name in dir_files of directory
+        self.size     = array('q')
+        self.mtime_ns = array('q')
+        self.dev      = array('Q')
+        self.ino      = array('Q')
+        self.nlink    = array('I')
+
+        # used during scan
+        self.ancestors = []             # (path, index) of the last directory and its parents
+        self.group    = array('I')      # size group of file, numbered in order of appearance
+        self.counts   = array('I')      # number of files in size group
+        self.count    = 0
+
+        # size => size group, a hash table with linear probing kept in
+        # arrays (a dict would take ~100 bytes per distinct size)
+        self.bits       = 10
+        self.slot_size  = array('q', [-1]) * (1 << self.bits)
+        self.slot_group = array('I', bytes(4 << self.bits))
+
+    NO_PARENT = 0xFFFFFFFF
+
+    def __len__(self):
+        return len(self.size)
+
+    def add_directory(self, dirpath, files):
+        """
+        add files of directory; directories come in order of scan, so a
+        directory whose parent is in the table is stored by name and index
+        of the parent, other ones (roots) by full path
+        """
+        ancestors = self.ancestors
+        parent = os.path.dirname(dirpath)
+        while ancestors and ancestors[-1][0] != parent:
+            ancestors.pop()
+
+        dir = len(self.dir_name)
+        if ancestors:
+            self.dir_parent.append(ancestors[-1][1])
+            self.dir_name.append(os.path.basename(dirpath))
+        else:
+            self.dir_parent.append(self.NO_PARENT)
+            self.dir_name.append(dirpath)
+
+        ancestors.append((dirpath.rstrip(os.sep) or dirpath, dir))
+
+        names = bytearray()
+        for info in files:
+            self.name.append(len(names))
+            names += os.fsencode(os.path.basename(info.path))
+            names += b'\0'
+            self.add(dir, info)
+
+        self.dir_files.append(bytes(names))
+
+    def add(self, dir, info):
+        if not self.unique:
+            self.group.append(self.size_group(info.size))
+
+        self.append(dir, info)
+        self.count += 1
+
+    def size_group(self, size):
+        "returns size group of file, counting its files"
+        slot_size = self.slot_size
+        mask  = len(slot_size) - 1
+        slot  = ((size * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - self.bits)
         while True:
-            buf = file.read(bufsize)
-            if not buf:
+            key = slot_size[slot]
+            if key == size:
+                group = self.slot_group[slot]
+                self.counts[group] += 1
+                return group
+
+            if key == -1:
                 break
-            sum.update(buf)
 
-        file.close()
-        return sum.digest()
+            slot = (slot + 1) & mask
+
+        group = len(self.counts)
+        self.counts.append(1)
+        slot_size[slot] = size
+        self.slot_group[slot] = group
+        if 2 * len(self.counts) > len(slot_size):
+            self.grow()
+
+        return group
+
+    def grow(self):
+        old_size  = self.slot_size
+        old_group = self.slot_group
+
+        self.bits += 1
+        self.slot_size  = slot_size = array('q', [-1]) * (1 << self.bits)
+        self.slot_group = array('I', bytes(4 << self.bits))
+        mask = len(slot_size) - 1
+        for size, group in zip(old_size, old_group):
+            if size == -1:
+                continue
+
+            slot = ((size * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - self.bits)
+            while slot_size[slot] != -1:
+                slot = (slot + 1) & mask
+
+            slot_size[slot] = size
+            self.slot_group[slot] = group
+
+    def append(self, dir, info):
+        self.dir.append(dir)
+        self.size.append(info.size)
+        self.mtime_ns.append(info.mtime_ns)
+        self.dev.append(info.dev)
+        self.ino.append(info.ino)
+        self.nlink.append(info.nlink)
+
+    def groups(self):
+        """
+        Ends scan and returns groups of files having the same size, in
+        order of the first file of each size, as IndexRanges.  Files of
+        unique sizes are removed from the table, indices of the other
+        ones change.
+        """
+        counts = self.counts
+
+        # counting sort: start of each group in the new order
+        offsets = array('I', bytes(4 * len(counts)))
+        bounds  = array('I')
+        total   = 0
+        for group, count in enumerate(counts):
+            if count > 1:
+                offsets[group] = total
+                bounds.append(total)
+                total += count
+        bounds.append(total)
+
+        order = array('I', bytes(4 * total))
+        for i, group in enumerate(self.group):
+            if counts[group] > 1:
+                order[offsets[group]] = i
+                offsets[group] += 1
+
+        del offsets
+        for column in ('dir', 'name', 'size', 'mtime_ns', 'dev', 'ino', 'nlink'):
+            old = getattr(self, column)
+            setattr(self, column, array(old.typecode, (old[i] for i in order)))
+
+        self.ancestors  = []
+        self.group      = array('I')
+        self.counts     = array('I')
+        self.slot_size  = array('q')
+        self.slot_group = array('I')
+
+        return IndexRanges(None, bounds)
+
+    def dirpath(self, dir):
+        parts = []
+        while dir != self.NO_PARENT:
+            parts.append(self.dir_name[dir])
+            dir = self.dir_parent[dir]
+
+        return join(*reversed(parts))
+
+    def path(self, i):
+        names = self.dir_files[self.dir[i]]
+        start = self.name[i]
+        name  = os.fsdecode(names[start:names.index(b'\0', start)])
+        return join(self.dirpath(self.dir[i]), name)
+
+    def info(self, i):
+        return FileInfo(self.path(i), self.size[i], self.mtime_ns[i],
+                        self.dev[i], self.ino[i], self.nlink[i])
+
+
+class IndexRanges:
+    "list of groups of indices, stored as ranges of one array"
+
+    def __init__(self, order, bounds):
+        self.order  = order     # indices, None if they are consecutive
+        self.bounds = bounds    # group i is order[bounds[i]:bounds[i + 1]]
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        if self.order is None:
+            return list(range(self.bounds[i], self.bounds[i + 1]))
+
+        return self.order[self.bounds[i]:self.bounds[i + 1]].tolist()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def read_directory(dirpath, onerror, recursive=True, match=None):
+    """
+    Returns pair (list of FileInfo, list of subdirectories) for directory.
+
+    Stat results cached by os.scandir are used, thus for a regular file
+    just one lstat is issued (none for directories and symbolic links).
+    Symbolic links are skipped.  Subdirectories not accepted by match
+    (called with name of directory) are not returned.
+    """
+    files   = []
+    subdirs = []
+    try:
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and (match is None or match(entry.name)):
+                            subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        files.append(FileInfo(entry.path, st.st_size, st.st_mtime_ns,
+                                              st.st_dev, st.st_ino, st.st_nlink))
+                except KeyboardInterrupt:
+                    raise
+                except OSError:
+                    onerror()
+    except KeyboardInterrupt:
+        raise
+    except OSError:
+        onerror()
+
+    return (files, subdirs)
 
-    def save(self, filename):
-        import pickle
-        pickle.dump(self.cache, open(filename, "wb"), pickle.HIGHEST_PROTOCOL)
 
-    def load(self, filename):
-        import pickle
-        self.cache = pickle.load(open(filename, "rb"))
+def scan_tree(directory, onerror, recursive=True, match=None):
+    """
+    Yields pairs (dirpath, list of FileInfo) for directory and its
+    subdirectories, in the same order as os.walk does.
+    """
+    stack = [directory]
+    while stack:
+        dirpath = stack.pop()
+        files, subdirs = read_directory(dirpath, onerror, recursive, match)
 
+        yield (dirpath, files)
 
-class Md5ShortCache(Md5Cache):
-    "cache for md5 sums of first 4kB of files"
-    def calc_sum(self, filename):
-        file    = open(filename, 'rb')
-        bufsize = 4096
-        sum     = md5()
-        sum.update(file.read(bufsize))
-        file.close()
-        return sum.digest()
+        stack.extend(reversed(subdirs))
+
+
+def scan_trees(directories, onerror, jobs=1, recursive=True, match=None, window=None):
+    """
+    Yields pairs (dirpath, list of FileInfo) for all directories, in the
+    same order as scan_tree called for each directory does.
+
+    With jobs > 1 directories are read ahead by a pool of threads, at most
+    window directories (default 4 * jobs) are read or wait to be yielded
+    at once, the ones that come first in the order.  Results are yielded
+    in order as they are ready.
+    """
+    if jobs == 1:
+        for directory in directories:
+            yield from scan_tree(directory, onerror, recursive, match)
+
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    if window is None:
+        window = 4 * jobs
+
+    executor = ThreadPoolExecutor(jobs)
+
+    def read(dirpath):
+        return read_directory(dirpath, onerror, recursive, match)
+
+    # stack of [dirpath, future]; future is None until the read is submitted
+    stack   = [[directory, None] for directory in reversed(directories)]
+    pending = 0
+
+    def submit():
+        # reads are submitted in the order of stack from the top; at most
+        # window entries are submitted, so at most 2 * window are looked at
+        nonlocal pending
+        i = len(stack)
+        while pending < window and i > 0:
+            i -= 1
+            if stack[i][1] is None:
+                stack[i][1] = executor.submit(read, stack[i][0])
+                pending += 1
+
+    try:
+        while stack:
+            submit()
+            dirpath, future = stack.pop()
+            files, subdirs = future.result()
+            pending -= 1
+
+            yield (dirpath, files)
+
+            stack.extend([subdir, None] for subdir in reversed(subdirs))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def benchmark_scan(directories, out):
+    """
+    print time and number of stat calls per file needed to scan directories
+    with os.walk plus stat of each path, and with scan_tree
+    """
+    counters = {'stat': 0}
+
+    class Entry:
+        "DirEntry that counts calls of stat()"
+        def __init__(self, entry):
+            self.entry = entry
+            self.name  = entry.name
+            self.path  = entry.path
+
+        def __getattr__(self, name):
+            return getattr(self.entry, name)
+
+        def stat(self, *args, **kwargs):
+            counters['stat'] += 1
+            return self.entry.stat(*args, **kwargs)
+
+    class Scandir:
+        def __init__(self, *args):
+            self.it = orig_scandir(*args)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.it.close()
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            return Entry(next(self.it))
+
+    def counted(function):
+        def wrapper(*args, **kwargs):
+            counters['stat'] += 1
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    def walk():
+        # scan as it was done before: os.walk, then islink and getsize
+        # during scan, and getmtime in each cache lookup
+        n = 0
+        for directory in directories:
+            for root, dirs, files in os.walk(directory):
+                for file in files:
+                    path = join(root, file)
+                    if not os.path.islink(path) and os.path.getsize(path) > 0:
+                        os.path.getmtime(path)
+                        n += 1
+
+        return n
+
+    def scan():
+        n = 0
+        for directory in directories:
+            for root, files in scan_tree(directory, lambda: None):
+                n += sum(1 for info in files if info.size > 0)
+
+        return n
+
+    orig_scandir = os.scandir
+    orig_stat    = os.stat
+    orig_lstat   = os.lstat
+    try:
+        os.scandir = Scandir
+        os.stat    = counted(orig_stat)
+        os.lstat   = counted(orig_lstat)
+        for name, function in [("os.walk", walk), ("scan_tree", scan)]:
+            counters['stat'] = 0
+            t0 = time.perf_counter()
+            n  = function()
+            t  = time.perf_counter() - t0
+            out.write("%-10s %8d files %8.3f s %6.2f stat calls/file\n" %
+                      (name, n, t, counters['stat'] / max(n, 1)))
+    finally:
+        os.scandir = orig_scandir
+        os.stat    = orig_stat
+        os.lstat   = orig_lstat
+
+
+def group_by_contents(files, onerror, chunksize=65536, max_open=64):
+    """
+    Splits a list of same-size files (FileInfo) into groups of equal files.
+
+    Files are read in lockstep, chunk by chunk; a group is split as
+    soon as contents diverge, and a file is dropped when it differs
+    from all others.  At most max_open files are kept opened, files
+    of bigger groups are reopened for each chunk.  When reading a
+    file fails, onerror is called from the except block and the
+    file is skipped.
+    """
+    result  = []
+    opened  = {}                # FileInfo => file object
+    pending = [(0, files)]      # (offset, files equal up to offset)
+
+    def close(group):
+        for info in group:
+            if info in opened:
+                opened.pop(info).close()
+
+    def read(info, offset, keep_open):
+        try:
+            if info in opened:
+                return opened[info].read(chunksize)
+
+            file = open(info.path, 'rb')
+            if keep_open:
+                opened[info] = file
+            else:
+                file.seek(offset)
+
+            try:
+                return file.read(chunksize)
+            finally:
+                if not keep_open:
+                    file.close()
+        except KeyboardInterrupt:
+            raise
+        except:
+            onerror()
+            close([info])
+
+    try:
+        while pending:
+            offset, group = pending.pop()
+            keep_open = all(info in opened for info in group) or len(opened) + len(group) <= max_open
+
+            chunks = Dict()
+            for info in group:
+                chunk = read(info, offset, keep_open)
+                if chunk is not None:
+                    chunks[chunk] = info
+
+            for chunk, group in chunks.items():
+                if len(group) == 1 or not chunk:    # unique file or end of files
+                    close(group)
+                    result.append(group)
+                else:
+                    pending.append((offset + len(chunk), group))
+    finally:
+        close(list(opened))
+
+    return result
+
+
+class Stats:
+    "time and amount of data read by stages of a run"
 
+    def __init__(self):
+        self.stages = []    # (name, seconds, files read or None, bytes read or None)
+
+    def add(self, name, seconds, files=None, bytes=None):
+        self.stages.append((name, seconds, files, bytes))
+
+    def report(self, out, caches):
+        def optional(format, value):
+            return "-" if value is None else format % value
+
+        out.write("%-28s %9s %10s %10s %9s\n" % ("stage", "time [s]", "files read", "MB read", "MB/s"))
+        for name, seconds, files, bytes in self.stages:
+            if bytes is not None and seconds > 0:
+                speed = bytes / seconds / 1e6
+            else:
+                speed = None
 
-def files_head_equal(path1, path2):
-    # assertion: size of files pointed by path1 and path2 are equal
-    bufsize = 4096
-    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
-        if f1.read(bufsize) != f2.read(bufsize):
-            return False
+            out.write("%-28s %9.2f %10s %10s %9s\n" % (name, seconds,
+                      optional("%d", files), optional("%.1f", None if bytes is None else bytes / 1e6),
+                      optional("%.1f", speed)))
 
-    return True
+        out.write("%-28s %9.2f\n" % ("cache writes", sum(cache.flush_time for cache in caches)))
+
+        for cache in caches:
+            total = cache.hits + cache.misses
+            if total:
+                out.write("cache %-12s hits %d, misses %d (%.1f%% hits)\n" %
+                          (cache.table, cache.hits, cache.misses, 100.0 * cache.hits / total))
 
 
 def main():
     options, directories = parse_args(sys.argv)
 
+    if options.profile:
+        import cProfile
+        cProfile.runctx("run(options, directories)", globals(), locals(), options.profile)
+    else:
+        run(options, directories)
+
+
+def run(options, directories):
+
     # set up print-status function
     class Status:
         def __init__(self, quiet, max_width=72):
@@ -173,13 +1540,39 @@ def main():
             self.progress  = 0.0
             self.file = sys.stderr
 
+            # stage reading files: progress is measured in bytes
+            self.total_bytes = 0
+            self.done_bytes  = 0
+            self.start_time  = 0.0
+
             if self.file.isatty() and not quiet:
                 self.write = self.__print_stdout
             else:
                 self.write = self.__print_dummy
 
+        def start(self, total_bytes):
+            "start stage that reads total_bytes of files"
+            self.total_bytes = total_bytes
+            self.done_bytes  = 0
+            self.start_time  = time.monotonic()
+
+        def advance(self, nbytes):
+            self.done_bytes += nbytes
+
         def __print_stdout(self, string, path=""):
-            string = "%4.1f %s" % (100.0 * self.progress, string)
+            if self.total_bytes:
+                elapsed = time.monotonic() - self.start_time
+                speed   = self.done_bytes / elapsed if elapsed > 0 else 0.0
+                left    = self.total_bytes - self.done_bytes
+                if speed > 0:
+                    eta = "%d:%02d" % divmod(int(left / speed), 60)
+                else:
+                    eta = "?"
+
+                string = "%4.1f %.1fMB/s ETA %s %s" % (100.0 * self.done_bytes / self.total_bytes,
+                                                       speed / 1e6, eta, string)
+            else:
+                string = "%4.1f %s" % (100.0 * self.progress, string)
             n = len(string)
             k = len(path)
 
@@ -208,6 +1601,7 @@ def main():
             sys.stderr.write(string + "\n")
 
     status = Status(options.quiet)
+    stats  = Stats()
 
     def printerror():
         if options.print_traceback:
@@ -217,29 +1611,104 @@ def main():
             info = sys.exc_info()
             status.error("%s: %s" % (info[0].__name__, info[1]))
 
-    # load md5cache
-    md5cache = Md5Cache()
-    md5headcache = Md5ShortCache()
+    # open md5cache
     configroot = Path.home() / ".local" / "share" / "finddups.py"
     configroot.mkdir(parents=True, exist_ok=True)
-    md5cache_path = configroot / "md5cache.pickle"
-    md5headcache_path = configroot / "md5headcache.pickle"
-    try:
-        md5cache.load(md5cache_path)
-    except KeyboardInterrupt:
-        raise
-    except:
-        status.error(f"Can't load {md5cache_path} file")
-        printerror()
-
+    cache_path = configroot / "cache.sqlite"
     try:
-        md5headcache.load(md5headcache_path)
+        db = open_cache(cache_path)
     except KeyboardInterrupt:
         raise
     except:
-        status.error(f"Can't load {md5headcache_path} file")
+        status.error(f"Can't open {cache_path} file")
         printerror()
-
+        db = open_cache(":memory:")
+
+    md5cache = Md5Cache(db, options.algorithm, options.bufsize,
+                        options.checkpoint_files, options.checkpoint_seconds)
+    if options.drop_cache:
+        md5cache.calc_sum = partial(md5cache.calc_sum, drop_cache=True)
+    partial_caches = [partial_stages[name][0](db, options.algorithm, None,
+                                              options.checkpoint_files, options.checkpoint_seconds)
+                      for name in options.stages]
+    all_caches = [md5cache] + partial_caches    # flushed at exit
+
+    # state of run, saved after each stage; files are named after the run,
+    # so runs for other directories or options don't overwrite each other
+    run_id = (os.getcwd(), [normpath(abspath(dir)) for dir in directories], options.abspath,
+              options.stages, options.algorithm, options.compare, options.similar_images)
+    run_key = hashlib.sha1(repr(run_id).encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+
+    state_path = configroot / ("state-%s.pickle" % run_key)
+    table_path = configroot / ("state-%s-table.pickle" % run_key)
+    table      = FileTable(unique=False)
+    images     = FileTable()    # used by --similar-images
+    hardlinks  = {}     # (device, inode) => all paths of inode
+
+    def checkpoint(stage, file_groups):
+        md5cache.flush()
+        for cache in partial_caches:
+            cache.flush()
+        try:
+            if stage == 0:
+                save_state(table_path, (table, images))
+
+            save_state(state_path, {
+                'run_id'     : run_id,
+                'stage'      : stage,
+                'file_groups': file_groups,
+                'hardlinks'  : hardlinks,
+            })
+        except KeyboardInterrupt:
+            raise
+        except:
+            status.error(f"Can't save {state_path} file")
+            printerror()
+
+    state = None
+    if options.resume:
+        try:
+            state = load_state(state_path)
+            table, images = load_state(table_path)
+        except FileNotFoundError:
+            status.error("No saved state of run for these directories, options and working directory")
+            sys.exit(1)
+        except KeyboardInterrupt:
+            raise
+        except:
+            status.error(f"Can't load {state_path} file")
+            printerror()
+            sys.exit(1)
+
+        if state['run_id'] != run_id:
+            status.error("Saved state was created for different directories, options or working directory")
+            sys.exit(1)
+
+        hardlinks = state['hardlinks']
+
+    if options.reference:
+        try:
+            reference = ReferenceIndex(options.reference)
+        except KeyboardInterrupt:
+            raise
+        except:
+            status.error(f"Can't load index {options.reference}")
+            printerror()
+            sys.exit(1)
+
+        if reference.algorithm != options.algorithm:
+            status.error("Index %s was built with %s checksums, use --hash %s" %
+                         (options.reference, reference.algorithm, reference.algorithm))
+            sys.exit(1)
+
+    if options.log_file is not None:
+        try:
+            log = open(options.log_file, "wt")
+        except OSError:
+            printerror()
+            sys.exit(1)
+    else:
+        log = sys.stdout
 
     try:
         # Scanning directories
@@ -254,118 +1723,367 @@ def main():
 
                 return True
         else:
-            match = lambda _: False
+            match = None
 
-        d = Dict()
-        for directory in directories:
-            for root, dirs, files in os.walk(directory):
-                status.write("Scanning: ", root)
-
-                for file in files:
-                    path = join(root, file)
-                    if not islink(path):    # do not consider links
-                        try:
-                            size = getsize(path)
-                            if size > 0:
-                                d[size] = abspath(path) if options.abspath else path
-                        except KeyboardInterrupt:
-                            raise
-                        except:
-                            printerror()
+        if options.abspath:
+            roots = [abspath(directory) for directory in directories]
+        else:
+            roots = directories
 
-                if options.no_recursive:    # do not go deeper
-                    del dirs[:]
-                elif options.exclude:
-                    newdirs = [dir for dir in dirs if match(dir)]
-                    del dirs[:]
-                    dirs.extend(newdirs)
+        # set up workers: threads are good for reading heads of files,
+        # full checksums may be also calculated in separate processes
+        if options.jobs > 1:
+            from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-        def group_by_first4kb(file_groups):
-            result = []
+            head_executor = ThreadPoolExecutor(options.jobs)
+            if options.processes:
+                sum_executor = ProcessPoolExecutor(options.jobs)
+            else:
+                sum_executor = head_executor
+        else:
+            head_executor = None
+            sum_executor  = None
 
-            for file_list in file_groups:
-                dict = Dict()
-                for file in file_list:
-                    status.write("read head of ", file)
-                    try:
-                        head = md5headcache.get_sum(file)
+        # with --io-order each device gets its own pool of threads
+        if options.io_order != 'none' and head_executor is not None:
+            read_executor = DeviceExecutors(options.jobs)
+        else:
+            read_executor = head_executor
 
-                        dict[head] = file
-                    except KeyboardInterrupt:
-                        raise
-                    except:
-                        printerror()
+        window = 4 * options.jobs
 
-                result.extend(dict.values())
+        def scan_files(roots):
+            "yields FileInfo of not empty files"
+            for root, files in scan_trees(roots, printerror, options.scan_jobs, not options.no_recursive, match):
+                status.write("Scanning: ", root)
+                for info in files:
+                    if info.size > 0:
+                        yield info
+
+        refheadcache = Md5ShortCache(db, options.algorithm, None,
+                                     options.checkpoint_files, options.checkpoint_seconds)
+        all_caches.append(refheadcache)
+
+        def make_reference(path, roots):
+            "save size and checksums of all files in index"
+            tmp = str(path) + ".tmp"
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+            index = ReferenceIndex(tmp, options.algorithm)
+            heads = get_sums(refheadcache, scan_files(roots), printerror, head_executor, window)
+            sums  = get_sums(md5cache, heads, printerror, sum_executor, window,
+                             getinfo=lambda item: item[0])
+            count = 0
+            for (info, head), sum in sums:
+                status.write("index ", info.path)
+                index.add(info.size, head, sum, abspath(info.path), info.dev, info.ino)
+                count += 1
+
+            index.close()
+            os.replace(tmp, path)
+            status.write("\n")
+            status.error("Indexed %d files" % count)
+
+        def find_in_reference(index, roots):
+            """
+            yields pairs (path from index, path of new file), so only
+            new files are removed by the shell script
+            """
+            # each stage reads more, and is done only for files matching so far
+            candidates = (info for info in scan_files(roots) if index.has_size(info.size))
+            heads = get_sums(refheadcache, candidates, printerror, head_executor, window)
+            heads = (item for item in heads if index.has_head(item[0].size, item[1]))
+            sums  = get_sums(md5cache, heads, printerror, sum_executor, window,
+                             getinfo=lambda item: item[0])
+            for (info, head), sum in sums:
+                status.write("calc. checksum of ", info.path)
+                # the file itself (or its hardlink) may be in the index,
+                # when the directories overlap the archive: then it's
+                # a part of the archive and it's never reported
+                rows = index.find(info.size, sum)
+                if rows and all((dev, ino) != (info.dev, info.ino) for path, dev, ino in rows):
+                    yield (sum, info.size, [rows[0][0], info.path], None)
+
+
+        inodes = {}     # (device, inode) => path, only for files having many links
+        dirs   = set()  # (device, inode) of scanned directories, e.g. bind mounts are scanned once
+        if state is None and not (options.reference or options.make_reference):
+            table_roots = roots
+        else:
+            table_roots = []
+
+        t0 = time.monotonic()
+        for root, files in scan_trees(table_roots, printerror, options.scan_jobs, not options.no_recursive, match):
+            status.write("Scanning: ", root)
+
+            try:
+                st = os.stat(root)
+            except KeyboardInterrupt:
+                raise
+            except:
+                printerror()
+                continue
+
+            if (st.st_dev, st.st_ino) in dirs:
+                continue
+
+            dirs.add((st.st_dev, st.st_ino))
+
+            selected = []
+            image_files = []
+            for info in files:
+                if info.size > 0:
+                    # each inode is read once, other paths are just hardlinks
+                    if info.nlink > 1:
+                        inode = (info.dev, info.ino)
+                        if inode in inodes:
+                            hardlinks.setdefault(inode, [inodes[inode]]).append(info.path)
+                            continue
+
+                        inodes[inode] = info.path
+
+                    if options.similar_images and info.path.lower().endswith(image_extensions):
+                        image_files.append(info)
+
+                    selected.append(info)
+
+            table.add_directory(root, selected)
+            if image_files:
+                images.add_directory(root, image_files)
+
+        if table_roots:
+            stats.add("scan (%d files)" % table.count, time.monotonic() - t0)
+
+        # Each group_by function yields, for each group of files, a list
+        # of pairs (key, files) - files of the group split by key.
+
+        def group_by_cache(file_groups, cache, executor, message):
+            # all files are passed at once, so workers are never starved
+            # on small groups; results arrive in the order of files
+            def files():
+                for group_id, file_list in enumerate(file_groups):
+                    for file in file_list:
+                        yield (group_id, file)
+
+            if options.io_order != 'none':
+                yield from group_by_cache_ordered(file_groups, cache, executor, message)
+                return
+
+            items = get_sums(cache, files(), printerror, executor, window,
+                             getinfo=lambda item: table.info(item[1]))
+
+            # a group is complete when the first file of next one arrives
+            current = 0
+            dict    = Dict()
+            for (group_id, file), sum in items:
+                status.advance(cache.bytes_read(table.size[file]))
+                status.write(message, table.path(file))
+                while current < group_id:
+                    yield list(dict.items())
+                    current += 1
+                    dict = Dict()
+
+                dict[sum] = file
+
+            while current < len(file_groups):
+                yield list(dict.items())
+                current += 1
+                dict = Dict()
 
-            return result
+        def group_by_cache_ordered(file_groups, cache, executor, message):
+            # files are read in on-disk order, a group is complete when
+            # its last file arrives, so groups are yielded in any order
+            def getinfo(item):
+                return table.info(item[1])
+
+            ordered = io_order(((group_id, file)
+                                for group_id, file_list in enumerate(file_groups)
+                                for file in file_list), getinfo, options.io_order)
+            devices = len(set(table.dev[file] for group_id, file in ordered))
+            left    = [len(file_list) for file_list in file_groups]
+            dicts   = {}
+
+            def done(group_id):
+                left[group_id] -= 1
+                if left[group_id] == 0:
+                    # files are put back in order of scanning
+                    return [(key, sorted(files)) for key, files in dicts.pop(group_id, {}).items()]
+
+            # get_sums skips files that failed, positions of items tell which
+            items = get_sums(cache, enumerate(ordered), printerror, executor,
+                             window * max(1, devices), getinfo=lambda item: getinfo(item[1]))
+
+            expected = 0
+            for (position, (group_id, file)), sum in items:
+                status.advance(cache.bytes_read(table.size[file]))
+                status.write(message, table.path(file))
+                dicts.setdefault(group_id, Dict())[sum] = file
+                for i in range(expected, position + 1):
+                    result = done(ordered[i][0])
+                    if result is not None:
+                        yield result
+
+                expected = position + 1
+
+            for i in range(expected, len(ordered)):
+                result = done(ordered[i][0])
+                if result is not None:
+                    yield result
+
+        def group_by_partial(cache, message, previous):
+            # each stage drops unique files, before the next one reads more bytes;
+            # groups the stage can't split (see Md5Cache.splits) pass unchanged
+            def group_by(file_groups):
+                splits   = [cache.splits(table.size[files[0]], previous) for files in file_groups]
+                selected = [files for files, split in zip(file_groups, splits) if split]
+                results  = group_by_cache(selected, cache, read_executor, message)
+                for files, split in zip(file_groups, splits):
+                    yield next(results) if split else [(None, files)]
+
+            return group_by
 
 
         def group_by_md5sum(file_groups):
-            result = []
-
-            for file_list in file_groups:
-                dict = Dict()
-
-                for file in file_list:
-                    status.write("calc. MD5 of ", file)
-                    try:
-                        sum = md5cache.get_sum(file)
-                        dict[sum] = file
-                    except KeyboardInterrupt:
-                        raise
-                    except:
-                        printerror()
-
-                result.extend(dict.values())
+            executor = sum_executor if options.processes else read_executor
+            return group_by_cache(file_groups, md5cache, executor, "calc. checksum of ")
 
-            return result
 
+        def group_by_compare(file_groups):
+            def compare(files):
+                infos  = [table.info(i) for i in files]
+                index  = dict(zip(infos, files))
+                groups = group_by_contents(infos, printerror, options.chunksize, max_open)
+                return [[index[info] for info in group] for group in groups]
 
-        def group_files(dict):
-            duplicates = []
-            unique     = []
+            def submitted():
+                # at most window groups are submitted at once, as in get_sums
+                from collections import deque
 
-            group_by_functions = [
-                (lambda x: x,       'group by size'),
-                (group_by_first4kb, 'group by first 4kB'),
-                (group_by_md5sum,   'group by MD5 sum'),
-            ]
+                pending = deque()
+                for files in file_groups:
+                    pending.append(head_executor.submit(compare, files))
+                    if len(pending) > window:
+                        yield pending.popleft().result()
 
-            file_groups = dict.values()
+                while pending:
+                    yield pending.popleft().result()
 
-            for group_by, group_by_name in group_by_functions:
+            if head_executor is None:
+                max_open = options.max_open
+                groups   = map(compare, file_groups)
+            else:
+                max_open = max(2, options.max_open // options.jobs)
+                groups   = submitted()
+
+            for files, groups in zip(file_groups, groups):
+                status.advance(len(files) * table.size[files[0]])
+                status.write("compare ", table.path(files[0]))
+                yield [(None, group) for group in groups]
+
+
+        def group_files(file_groups, first_stage=0):
+            """
+            Yields pairs (key, files) for groups of duplicates, as soon as
+            the last stage confirms them; key is checksum of files or None.
+            """
+            # (function, name, cache or None)
+            group_by_functions = [(lambda groups: ([(None, files)] for files in groups), 'group by size', None)]
+            for k, (name, cache) in enumerate(zip(options.stages, partial_caches)):
+                _, group_by_name, message = partial_stages[name]
+                group_by_functions.append((group_by_partial(cache, message, options.stages[:k]),
+                                           group_by_name, cache))
+
+            if options.compare:
+                group_by_functions.append((group_by_compare, 'compare contents', None))
+            else:
+                group_by_functions.append((group_by_md5sum, 'group by %s sum' % options.algorithm, md5cache))
+
+            last = len(group_by_functions) - 1
+            for stage, (group_by, group_by_name, cache) in enumerate(group_by_functions):
+                if stage < first_stage:
+                    continue
+
+                # amount of data to read, for progress and ETA
+                if stage == 0:
+                    status.start(0)
+                elif cache is None:
+                    status.start(sum(len(files) * table.size[files[0]] for files in file_groups))
+                else:
+                    previous = options.stages[:stage - 1]
+                    status.start(sum(len(files) * cache.bytes_read(table.size[files[0]])
+                                     for files in file_groups
+                                     if cache.splits(table.size[files[0]], previous)))
 
-                file_groups = group_by(file_groups)
+                if cache is not None:
+                    misses, nbytes = cache.misses, cache.bytes
 
+                t0    = time.monotonic()
                 total = float(len(file_groups))
                 tmp   = []
-                for curr, files in enumerate(file_groups):
+                for curr, groups in enumerate(group_by(file_groups)):
                     status.progress = curr/total
                     status.write(group_by_name)
-                    if len(files) == 1:
-                        unique.append(files[0])
-                    elif len(files) == 2:
-                        if files_head_equal(files[0], files[1]):
-                            duplicates.append(files)
+                    for key, files in groups:
+                        if len(files) == 1:     # unique file
+                            continue
+
+                        if stage == last:
+                            yield (key, files)
                         else:
                             tmp.append(files)
-                    else:
-                        tmp.append(files)
-
-                file_groups = tmp
-
-            duplicates.extend(file_groups)
-
-            return (unique, duplicates)
-
-
-        unique, duplicates = group_files(d)
 
-        if options.log_file is not None:
-            log = open(options.log_file, "wt")
+                if cache is not None:
+                    stats.add(group_by_name, time.monotonic() - t0, cache.misses - misses, cache.bytes - nbytes)
+                elif stage > 0:
+                    stats.add(group_by_name, time.monotonic() - t0, sum(len(files) for files in file_groups))
+
+                if stage < last:
+                    file_groups = tmp
+                    checkpoint(stage + 1, file_groups)
+
+
+        image_cache = ImageHashCache(db, options.image_hash, None,
+                                     options.checkpoint_files, options.checkpoint_seconds)
+        all_caches.append(image_cache)
+
+        def find_similar_images():
+            "yields clusters of similar images"
+            t0     = time.monotonic()
+            misses = image_cache.misses
+            hashes = get_sums(image_cache, range(len(images)), printerror, sum_executor, window,
+                              getinfo=images.info)
+
+            def items():
+                for i, hash in hashes:
+                    status.write("image hash of ", images.path(i))
+                    yield (i, int.from_bytes(hash, 'big'))
+
+            for cluster in cluster_by_hash(items(), options.similar_threshold):
+                yield (None, None, [images.path(i) for i in sorted(cluster)], None)
+
+            image_cache.flush()
+            stats.add("similar images (%d)" % len(images), time.monotonic() - t0,
+                      image_cache.misses - misses)
+
+        def find_duplicates(duplicates):
+            for key, files in duplicates:
+                yield (key, table.size[files[0]], [table.path(i) for i in files], files)
+
+        # all modes yield tuples (key, size, paths, indices in table or None)
+        if options.make_reference:
+            make_reference(options.make_reference, roots)
+            results = []
+        elif options.reference:
+            results = find_in_reference(reference, roots)
+        elif state is None:
+            file_groups = table.groups()
+            del inodes, dirs
+            checkpoint(0, file_groups)
+            results = find_duplicates(group_files(file_groups))
         else:
-            log = sys.stdout
+            results = find_duplicates(group_files(state['file_groups'], state['stage']))
+
 
         if options.quote:
             def quote(string):
@@ -375,8 +2093,44 @@ def main():
                 return string
 
 
-        for file_list in duplicates:
-            if options.sort:
+        def write_list(log, file_list):
+            log.write(quote(file_list[0]))
+            for file in file_list[1:]:
+                log.write(options.separator + quote(file))
+            else:
+                log.write("\n")
+
+        def write_group(log, key, size, file_list, similar=False):
+            if options.format == 'jsonl':
+                log.write(json.dumps({
+                    'similar'  : similar,
+                    'size'     : size,
+                    'algorithm': None if key is None else options.algorithm,
+                    'digest'   : None if key is None else key.hex(),
+                    'wasted'   : None if size is None else size * (len(file_list) - 1),
+                    'files'    : file_list,
+                }) + "\n")
+            elif options.format == 'null':
+                log.write("\0".join(file_list) + "\0\0")
+            else:
+                write_list(log, file_list)
+
+            log.flush()
+
+        if options.dedupe:
+            from concurrent.futures import ThreadPoolExecutor
+
+            dedupe_executor = ThreadPoolExecutor(options.jobs)
+            dedupe_futures  = []
+
+        # groups are written as soon as they're found
+        for key, size, file_list, files in results:
+            if options.dedupe:
+                dedupe_futures.append(dedupe_executor.submit(
+                    dedupe_group, [table.info(i) for i in files], options.dedupe, hardlinks, printerror,
+                    options.chunksize, max(2, options.max_open // options.jobs)))
+
+            if options.sort and not options.reference:
                 file_list.sort()
 
             if options.shell:
@@ -384,26 +2138,70 @@ def main():
                 for fi in file_list[1:]:
                     assert f0 != fi
                     log.write("cmp %s %s && rm %s\n" % (f0, fi, fi))
+                log.flush()
             else:
-                log.write(quote(file_list[0]))
-                for file in file_list[1:]:
-                    log.write(options.separator + quote(file))
-                else:
-                    log.write("\n")
+                write_group(log, key, size, file_list)
+
+        # similar images are not duplicates, they go to a separate file
+        if options.similar_images:
+            with open(options.similar_images, "wt") as f:
+                for key, size, file_list, files in find_similar_images():
+                    if options.sort:
+                        file_list.sort()
+
+                    write_group(f, key, size, file_list, similar=True)
+
+        if head_executor is not None:
+            head_executor.shutdown()
+        if sum_executor is not None:
+            sum_executor.shutdown()
+        if read_executor is not head_executor:
+            read_executor.shutdown()
+
+        if options.dedupe:
+            reclaimed = sum(future.result() for future in dedupe_futures)
+            dedupe_executor.shutdown()
+            status.error("Reclaimed %d bytes" % reclaimed)
+
+        if options.hardlinks_file is not None:
+            with open(options.hardlinks_file, "wt") as f:
+                for paths in hardlinks.values():
+                    file_list = list(paths)
+                    if options.sort:
+                        file_list.sort()
+
+                    write_list(f, file_list)
 
         status.write("\n")
 
+        if options.stats:
+            caches = [md5cache] + partial_caches
+            if options.similar_images:
+                caches.append(image_cache)
+            if options.reference or options.make_reference:
+                caches.append(refheadcache)
+
+            stats.report(sys.stderr, caches)
+
+        # the run is complete, nothing to resume
+        if not (options.reference or options.make_reference):
+            for path in (state_path, table_path):
+                if path.exists():
+                    path.unlink()
+
     except KeyboardInterrupt:
         raise
     except:
         printerror()
-
-    try:
-        md5cache.save(md5cache_path)
-        md5headcache.save(md5headcache_path)
-    except:
-        status.error("Can't save cache file(s)")
-        printerror()
+    finally:
+        # checksums calculated so far are saved even when interrupted
+        try:
+            for cache in all_caches:
+                cache.flush()
+            db.close()
+        except:
+            status.error("Can't save cache file(s)")
+            printerror()
 
     log.close()
 
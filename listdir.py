@@ -13,8 +13,10 @@ import os
 import os.path
 import hashlib
 import sys
+import threading
 import concurrent.futures
 
+from collections import deque
 from os.path import join, getsize
 
 def main(args):
@@ -43,22 +45,37 @@ def main(args):
         help()
 
 
-def make_list(root_directory, out, getchecksum):
+def make_list(root_directory, out, getchecksum, jobs=None):
     root_directory = os.path.normpath(os.path.abspath(root_directory))
     n = len(root_directory)
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        checksums = []
+    if jobs is None:
+        jobs = min(32, (os.cpu_count() or 1) + 4)
+
+    # at most window files are processed at once; lines are written
+    # in order of traversal, as soon as their checksums are ready
+    window  = 4 * jobs
+    pending = deque()
+
+    def write():
+        path, future = pending.popleft()
+        checksum, size = future.result()
+        out.write("%s %10d %s\n" % (checksum, size, path[n:]))
+
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
         for root, dirs, files in os.walk(root_directory):
             for file in files:
                 path = join(root, file)
-                future = executor.submit(getchecksum, path)
-                checksums.append((path, future))
+                pending.append((path, executor.submit(checksum_and_size, path, getchecksum)))
+                if len(pending) > window:
+                    write()
+
+        while pending:
+            write()
 
-        for path, future in checksums:
-            checksum = future.result()
-            s = "%s %10d %s\n" % (checksum, getsize(path), path[n:])
-            out.write(s)
+
+def checksum_and_size(path, getchecksum):
+    return (getchecksum(path), getsize(path))
 
 
 def compare(list1, list2, prefix, out):
@@ -67,10 +84,22 @@ def compare(list1, list2, prefix, out):
         out.write(s + "\n")
 
 
-def getsha512sum(path):
+# read buffers are reused by all calls made in a thread
+buffers = threading.local()
+
+def getsha512sum(path, bufsize=1024*1024):
+    buf = getattr(buffers, 'buf', None)
+    if buf is None or len(buf) != bufsize:
+        buf = buffers.buf = bytearray(bufsize)
+
+    view = memoryview(buf)
     h = hashlib.sha512()
-    with open(path, 'rb') as f:
-        h.update(f.read())
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            k = f.readinto(buf)
+            if not k:
+                break
+            h.update(view[:k])
 
     return h.hexdigest()
 